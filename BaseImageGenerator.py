@@ -4,14 +4,8 @@ import argparse
 
 # Load custom library
 from boldli import ImageManipulatingLibrary as mil
-
-# For loading/saving the images
-from nipy.core.api import Image
-from nipy import load_image, save_image
-from nipype.interfaces import dcmstack
-
-# For resizing the 3D image
-from skimage.transform import resize
+from boldli import SequenceWriter, addCompressionArguments
+from boldli import addPrecisionArguments, setPrecision, getFloatType
 
 # For manipulating the coordinates
 from nipy.core.api import CoordinateSystem, AffineTransform
@@ -21,24 +15,39 @@ import SimpleITK as sitk
 
 
 ##
-# Replicate the volume of interest 150 times
+# Replicate the volume of interest along a new temporal axis
+#
+# The sequence is a read-only broadcast view of the volume, so no volume is
+# copied. Stages that modify the sequence should make a writable copy first
+# (see ImageManipulatingLibrary.ensureWritable).
 #
 # @param vol The image volume
-# @param coords The coordinates for the image sequence
+# @param length The number of volumes in the sequence
 #
-# @returns newSeq The new image sequence
-def replicateVolume(vol):
-    # Set up list for image sequence
-    newSeq = []
+# @returns newSeq The new image sequence as a read-only 4D numpy array
+def replicateVolume(vol, length=150):
+    newSeq = np.broadcast_to(vol[..., np.newaxis], vol.shape + (length,))
 
-    # Copy the new image into a list
-    for i in range(150):
-        newSeq.append(np.copy(vol))
-
-    # Return the list of copied volumes
     return newSeq
 
 
+##
+# Write a sequence of one repeated volume straight to a NIfTI file
+#
+# Only one volume is ever held in memory; it is written length times.
+#
+# @param vol The image volume
+# @param length The number of volumes in the sequence
+# @param coords The 4D coordinates for the image sequence
+# @param fn The location to save the image sequence to
+# @param compressLevel The gzip level (0-9) for .gz files, or None for the default
+# @param threads Number of threads to compress with
+def writeReplicatedSequence(vol, length, coords, fn, compressLevel=None, threads=1):
+    with SequenceWriter(fn, coords, vol.shape, length, vol.dtype, compressLevel, threads) as writer:
+        for i in range(length):
+            writer.write(vol)
+
+
 ##
 # Generate a 3D volumetric brain mask from the chosen image volume
 #
@@ -92,14 +101,18 @@ def convert3DCoordsTo4D(orig):
     return modified
 
 
-def main():
+def main(argv=None):
     # Future: add arguments for inFn, outFn, and volNum
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', type=str, help='/path/to/input/file')
     parser.add_argument('-o', '--output', type=str, help='/path/to/input/file')
     parser.add_argument('-n', '--volume-number', type=int, help='Which image volume to isolate. If missing, first volume in sequence will be used.')
+    parser.add_argument('-l', '--length', type=int, default=150, help='Number of volumes in the generated sequence')
+    addCompressionArguments(parser)
+    addPrecisionArguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    setPrecision(args.precision)
 
     # Specify filepaths
     inFn = args.input
@@ -126,11 +139,12 @@ def main():
         volume = mil.isolateVolume(sequence, volNum)
 
     # Normalize the image volume
+    volume = volume.astype(getFloatType(), copy=False)
     volume *= (1000.0/volume.max())
 
     # Replicate the volume
     print("Replicating the volume")
-    uniformSeq = replicateVolume(volume)
+    uniformSeq = replicateVolume(volume, args.length)
 
     # Get a mask of the volume
     print("Creating a mask of the volume")
@@ -138,16 +152,13 @@ def main():
     mask = generateMask(volumeImg)
     maskArray = sitk.GetArrayFromImage(mask)
     maskStack = mil.convertArrayToImage(np.array([maskArray]), coordinates)
-    mil.saveBOLD(maskStack, "generated_brain_mask.nii.gz")
+    mil.saveBOLD(maskStack, "generated_brain_mask.nii.gz", args.compress_level, args.compress_threads)
 
-    # Convert the list of replicated volumes into an Image object
-    print("Converting the list of replicated volumes to an image")
-    seqImg = mil.convertArrayToImage(uniformSeq, coordinates)
-    print("baseline sequence", seqImg.get_data().shape)
+    print("baseline sequence", uniformSeq.shape)
 
-    # Save the volume
+    # Stream the replicated volume to disk
     print("Saving the image")
-    mil.saveBOLD(seqImg, outFn)
+    writeReplicatedSequence(volume, args.length, coordinates, outFn, args.compress_level, args.compress_threads)
     print("Done")
     
 
@@ -3,45 +3,68 @@ import numpy as np
 import math
 import os
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from boldli import ImageManipulatingLibrary as mil
-
-from skimage.measure import regionprops
+from boldli import SequenceWriter, addCompressionArguments
+from boldli import addPrecisionArguments, setPrecision
+from transform_store import composeAffineMatrices, saveTransformStore, exportTransformStore
 
 ##
 # Calculate the center of mass for the image
 #
+# The center of the thresholded volume along each axis is the voxel
+# index weighted by the number of foreground voxels in each slice.
+#
 # @param vol The image volume
 #
 # @returns com Center of mass as a list
 def calculateCOM(vol):
     # Threshold the data
-    labeled = (vol > 0).astype(int)
-    # Calculate the properties of the data
-    properties = regionprops(labeled, vol)
-    # Get the centroid
-    centroid = properties[0].centroid
-    # Round to get the center of mass invoxels
-    com = [int(round(i)) for i in centroid]
+    mask = vol > 0
+    total = float(np.count_nonzero(mask))
+
+    com = []
+    for axis in range(mask.ndim):
+        # Count the foreground voxels in each slice along this axis
+        otherAxes = tuple(a for a in range(mask.ndim) if a != axis)
+        profile = np.count_nonzero(mask, axis=otherAxes)
+        # Round to get the center of mass in voxels
+        com.append(int(round(np.dot(profile, np.arange(len(profile)))/total)))
 
     return com
 
 ##
-# Generate an affine transformation with rotation and translation
+# Calculate the center of mass for every volume, reusing it between updates
+#
+# @param seq The image sequence as a 4D numpy array
+# @param interval Recompute the center every interval volumes. If 0, the
+#                 center of the first volume is used for the whole sequence
+#
+# @returns centers List of centers of mass, one per volume
+def calculateCenters(seq, interval=1):
+    centers = []
+
+    for i in range(seq.shape[-1]):
+        if i == 0 or (interval > 0 and i % interval == 0):
+            com = calculateCOM(mil.isolateVolume(seq, i))
+        centers.append(com)
+
+    return centers
+
+##
+# Generate the rotation matrix for rotations about the image's axes
 #
 # @param xdeg Degrees of rotation about the image's x axis
 # @param ydeg Degrees of rotation about the image's y axis
 # @param zdeg Degrees of rotation about the image's z axis
-# @param translation Tuple of 3 points specifying the translation to apply
-# @param center Tuple of 3 points specifying the center of the image
-# 
-# @returns transform An sitk.AffineTransform with rotation and translation components
-def generateAffineTransform(xdeg, ydeg, zdeg, translation, center):
+#
+# @returns matrix The 3x3 rotation matrix as a numpy array
+def generateRotationMatrix(xdeg, ydeg, zdeg):
     # Convert the angle from degrees to radians
     xrad = math.radians(-xdeg)
     yrad = math.radians(-ydeg)
     zrad = math.radians(-zdeg)
-    # Set up the new Affine Transform
-    transform = sitk.AffineTransform(3)
 
     # Generate the rotation matrices 
     # Rotation about the z axis
@@ -62,7 +85,25 @@ def generateAffineTransform(xdeg, ydeg, zdeg, translation, center):
     # Multiply the matrices together 
     matrix = zmatrix.dot(xmatrix.dot(ymatrix))
 
+    return matrix
+
+
+##
+# Generate an affine transformation with rotation and translation
+#
+# @param xdeg Degrees of rotation about the image's x axis
+# @param ydeg Degrees of rotation about the image's y axis
+# @param zdeg Degrees of rotation about the image's z axis
+# @param translation Tuple of 3 points specifying the translation to apply
+# @param center Tuple of 3 points specifying the center of the image
+# 
+# @returns transform An sitk.AffineTransform with rotation and translation components
+def generateAffineTransform(xdeg, ydeg, zdeg, translation, center):
+    # Set up the new Affine Transform
+    transform = sitk.AffineTransform(3)
+
     # Set the rotation aspect of the transform
+    matrix = generateRotationMatrix(xdeg, ydeg, zdeg)
     transform.SetMatrix(matrix.ravel())
 
     # Set the translation aspect of the transform
@@ -88,176 +129,290 @@ def performTransform(volume, transform):
 
     return transformed
 
-## 
-# Check reasonableness of angles being sent to the rotation transform generator
+# Bounds on the motion parameters, in the order
+# (x angle, y angle, z angle, x shift, y shift, z shift).
+# The reasonable rotations are -30 <= x <= 30, -20 <= y <= 45 and -75 <= z <= 75
+# degrees; the shift bounds are in voxels.
+MOTION_LOWER = np.array([-30.0, -20.0, -75.0, -10.0, -10.0, -10.0])
+MOTION_UPPER = np.array([30.0, 45.0, 75.0, 10.0, 10.0, 10.0])
+
+##
+# Accumulate steps into a random walk that is clamped to [lower, upper]
+#
+# Equivalent to adding one step at a time and clamping after each step, but
+# each pass is a vectorized operation over the rest of the walk. Only one
+# pass is needed per timepoint at which the walk hits a bound.
 #
-# @param xdeg Degrees of rotation about the x axis
-# @param ydeg Degrees of rotation about the y axis
-# @param zdeg Degrees of rotation about the z axis
+# @param steps 1D numpy array of steps
+# @param lower Float lower bound of the walk
+# @param upper Float upper bound of the walk
 #
-# @returns reasonableAngles A list of reasonable rotations
-def sanityCheckRotation(xdeg, ydeg, zdeg):
-    # Current reasonable criteria:
-    #   -30 <= x <= 30
-    #   -20 <= y <= 45
-    #   -75 <= z <= 75
-    xUpper = 30
-    xLower = -30
-    yUpper = 45
-    yLower = -20
-    zUpper = 75
-    zLower = -75
-
-    # Check x
-    if xdeg < xLower:
-        xdeg = xLower
-    elif xdeg > xUpper:
-        xdeg = xUpper
-
-    # Check y
-    if ydeg < yLower:
-        ydeg = yLower
-    elif ydeg > yUpper:
-        ydeg = yUpper
-
-    # Check z
-    if zdeg < zLower:
-        zdeg = zLower
-    elif zdeg > zUpper:
-        zdeg = zUpper
-
-    return xdeg, ydeg, zdeg
+# @returns walk 1D numpy array of the clamped cumulative sum of the steps
+def clampedCumulativeSum(steps, lower, upper):
+    walk = np.cumsum(steps)
+
+    while True:
+        outside = np.flatnonzero((walk < lower) | (walk > upper))
+        if len(outside) == 0:
+            break
+        # Clamp the first value out of bounds and carry the correction forward
+        t = outside[0]
+        walk[t:] += np.clip(walk[t], lower, upper) - walk[t]
+
+    return walk
 
 ##
-# Pick a value from a normal distribution to use to adjust a transform parameter
+# Generate the motion parameters for every volume of a sequence up front
+#
+# The first volume has no motion. Each following volume adds a normally
+# distributed step to every parameter, clamped to MOTION_LOWER/MOTION_UPPER.
 #
-# @param mean Float mean of the distribution (center)
-# @param std Float standard deviation of the distribution (width)
+# @param numVols Number of volumes in the sequence
+# @param rng The numpy.random.Generator to draw the steps from
+# @param rotationStd Standard deviation of the rotation steps in degrees
+# @param translationStd Standard deviation of the translation steps in voxels
+#
+# @returns trajectory numpy array of shape (numVols, 6) with the columns
+#          x angle, y angle, z angle, x shift, y shift, z shift
+def generateMotionTrajectory(numVols, rng=None, rotationStd=1.0, translationStd=0.0):
+    if rng is None:
+        rng = np.random.default_rng()
+
+    # Draw every step at once; the first volume does not move
+    std = np.array([rotationStd]*3 + [translationStd]*3)
+    steps = np.zeros((numVols, 6))
+    steps[1:] = rng.normal(0.0, 1.0, size=(numVols - 1, 6)) * std
+
+    trajectory = np.empty((numVols, 6))
+    for p in range(6):
+        trajectory[:, p] = clampedCumulativeSum(steps[:, p], MOTION_LOWER[p], MOTION_UPPER[p])
+
+    return trajectory
+
+##
+# Save a motion trajectory to a replay file
 #
-# @returns change The amount to change a transform parameter by
-def delta(mean=0.0, std=1.0):
-    change = np.random.normal(mean, std)
-    return change
+# @param fn Name of the .npz file to save the trajectory to
+# @param trajectory numpy array of shape (numVols, 6) of motion parameters
+# @param seed The seed the trajectory was generated with, or None
+def saveTrajectory(fn, trajectory, seed=None):
+    np.savez_compressed(fn, trajectory=trajectory, seed=-1 if seed is None else seed)
 
-## 
-# Save an affine transformation to a file
+##
+# Load a motion trajectory from a replay file
+#
+# @param fn Name of the .npz file to load the trajectory from
 #
-# @param transform An sitk.AffineTransform object
-# @param fn Name of the file to save the transform to as a string
-def saveTransformInfo(transform, fn):
-    sitk.WriteTransform(transform, fn)
+# @returns trajectory numpy array of shape (numVols, 6) of motion parameters
+def loadTrajectory(fn):
+    with np.load(fn) as data:
+        trajectory = data["trajectory"]
 
+    return trajectory
 
 ##
-# Write a line to a file
+# Replay a motion trajectory from a file, or generate a new one
+#
+# @param numVols Number of volumes in the sequence
+# @param fn Name of the replay file to load, or None to generate a trajectory
+# @param rng The numpy.random.Generator to draw a new trajectory from
+# @param rotationStd Standard deviation of the rotation steps in degrees
+# @param translationStd Standard deviation of the translation steps in voxels
+#
+# @returns trajectory numpy array of shape (numVols, 6) of motion parameters
+def getMotionTrajectory(numVols, fn=None, rng=None, rotationStd=1.0, translationStd=0.0):
+    if fn is None:
+        return generateMotionTrajectory(numVols, rng, rotationStd, translationStd)
+
+    trajectory = loadTrajectory(fn)
+    if trajectory.shape[0] < numVols:
+        raise ValueError("Trajectory in '"+fn+"' has "+str(trajectory.shape[0])+
+                         " volumes but the sequence has "+str(numVols))
+
+    return trajectory[:numVols]
+
+##
+# Write the motion parameters and centers for a whole sequence to a .csv file
 #
 # @param fn String representing the filename
-# @param line The line to write as a string
-def updateFile(fn, line):
-    # Add a newline character if line does not end with one
-    if not line.endswith("\n"):
-        line = line + "\n"
+# @param parameters List of motion parameter tuples, one per volume
+# @param centers List of centers of mass, one per volume
+def writeMotionLog(fn, parameters, centers):
+    lines = ["Volume Number, X Angle, Y Angle, Z Angle, X Translation, Y Translation, Z Translation, X Center, Y Center, Z Center\n"]
+    for i, (params, center) in enumerate(zip(parameters, centers)):
+        lines.append(str(i)+", "+", ".join(str(p) for p in params)+", "+", ".join(str(c) for c in center)+"\n")
+
+    # Write the whole log at once, replacing any earlier run
+    with open(fn, "w") as f:
+        f.writelines(lines)
+
+
+##
+# Apply one set of motion parameters to a single image volume
+#
+# @param vol The image volume as a 3D numpy array
+# @param params Tuple of (x angle, y angle, z angle, x shift, y shift, z shift)
+# @param center The center of mass to apply the transformation about
+#
+# @returns volNew The transformed image volume as a 3D numpy array
+def resampleVolume(vol, params, center):
+    vol = sitk.GetImageFromArray(vol)
+
+    # Generate transformation
+    transform = generateAffineTransform(params[0], params[1], params[2], tuple(params[3:]), center)
+
+    # Apply transformation to image
+    volTransformed = performTransform(vol, transform)
 
-    # Write the line to the file
-    with open(fn, "a+") as f:
-        f.write(line)
+    # Convert the Image to an array so we can work with it
+    volNew = sitk.GetArrayFromImage(volTransformed)
+
+    return volNew
+
+
+##
+# Apply motion to every volume of a sequence, optionally on a pool of workers
+#
+# At most 2*workers volumes are submitted ahead of the one being yielded, so
+# neither the queued inputs nor the finished outputs grow to the size of the
+# whole sequence when the consumer is slower than the pool.
+#
+# @param seq The image sequence as a 4D numpy array
+# @param parameters List of motion parameter tuples, one per volume
+# @param centers List of centers of mass, one per volume
+# @param workers Number of volumes to resample at once
+# @param pool Type of pool to use for multiple workers, either "thread" or "process"
+#
+# @returns An iterator of the transformed image volumes, in sequence order
+def resampleSequence(seq, parameters, centers, workers=1, pool="thread"):
+    vols = (mil.isolateVolume(seq, i) for i in range(len(parameters)))
+
+    if workers == 1:
+        for volNew in map(resampleVolume, vols, parameters, centers):
+            yield volNew
+    else:
+        if pool == "process":
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        # Keep a bounded window of volumes in flight, yielded in submission order
+        with executor:
+            pending = deque()
+            for vol, params, center in zip(vols, parameters, centers):
+                if len(pending) >= 2*workers:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(resampleVolume, vol, params, center))
+            while pending:
+                yield pending.popleft().result()
+
+
+##
+# Apply a motion trajectory to a whole sequence
+#
+# @param seq The image sequence as a 4D numpy array
+# @param trajectory numpy array of shape (numVols, 6) of motion parameters
+# @param comInterval Recompute the center of mass every comInterval volumes (0: once)
+# @param workers Number of volumes to resample at once
+# @param pool Type of pool to use for multiple workers, either "thread" or "process"
+#
+# @returns newSeq An iterator of the transformed image volumes, in sequence order
+# @returns centers List of the centers of mass used for each volume
+def addMotionToSequence(seq, trajectory, comInterval=1, workers=1, pool="thread"):
+    # Find the center of mass to rotate each volume about
+    centers = calculateCenters(seq, comInterval)
 
+    # Apply the motion to every volume
+    parameters = [tuple(float(p) for p in row) for row in trajectory]
+    print("Resampling", len(parameters), "volumes with", workers, "worker(s)")
+    newSeq = resampleSequence(seq, parameters, centers, workers=workers, pool=pool)
 
-def main():
+    return newSeq, centers
+
+
+##
+# Save the motion log and transform store for a sequence
+#
+# @param baseDir Directory to save motion_variables.csv and generated_transforms.npz to
+# @param trajectory numpy array of shape (numVols, 6) of motion parameters
+# @param centers List of the centers of mass used for each volume
+# @param exportTransforms If True, also write a .mat file per volume to generated_transforms/
+def saveMotionRecords(baseDir, trajectory, centers, exportTransforms=False):
+    logFn = os.path.join(baseDir, "motion_variables.csv")
+    storeFn = os.path.join(baseDir, "generated_transforms.npz")
+    transformDir = os.path.join(baseDir, "generated_transforms")
+
+    # Write the parameters and center for every transformation to the log file
+    parameters = [tuple(float(p) for p in row) for row in trajectory]
+    writeMotionLog(logFn, parameters, centers)
+
+    # Save the transformations for the whole sequence in one file
+    rotations = np.array([generateRotationMatrix(p[0], p[1], p[2]) for p in parameters])
+    matrices = composeAffineMatrices(rotations, trajectory[:, 3:], np.asarray(centers, dtype=np.float64))
+    saveTransformStore(storeFn, matrices, centers, trajectory)
+    if exportTransforms:
+        exportTransformStore(storeFn, transformDir)
+
+
+def main(argv=None):
     # Set up the argument parser
     parser = argparse.ArgumentParser(description="Add motion to a BOLD image.")
     # Add argument: input file name
     parser.add_argument("-i", "--input", type=str, help="Path to input file")
     # Add argument: output file name
     parser.add_argument("-o", "--output", type=str, help="Path to output file")
+    # Add argument: number of workers
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of volumes to resample in parallel")
+    # Add argument: type of worker pool
+    parser.add_argument("--pool", type=str, default="thread", choices=["thread", "process"], help="Type of worker pool to use")
+    # Add argument: random seed
+    parser.add_argument("--seed", type=int, help="Seed for the motion trajectory, for reproducible runs")
+    # Add argument: replay file to load the motion from
+    parser.add_argument("-t", "--trajectory", type=str, help="Replay file (.npz) to load the motion trajectory from")
+    # Add argument: replay file to save the motion to
+    parser.add_argument("--save-trajectory", type=str, help="Replay file (.npz) to save the motion trajectory to")
+    # Add argument: size of the rotation steps
+    parser.add_argument("--rotation-std", type=float, default=1.0, help="Standard deviation of the rotation steps in degrees")
+    # Add argument: size of the translation steps
+    parser.add_argument("--translation-std", type=float, default=0.0, help="Standard deviation of the translation steps in voxels")
+    # Add argument: how often to recompute the center of mass
+    parser.add_argument("--com-interval", type=int, default=1, help="Recompute the center of mass every N volumes (0: once per sequence)")
+    # Add argument: also write per-volume .mat files
+    parser.add_argument("--export-transforms", action="store_true", help="Also write a .mat file per volume to generated_transforms/")
+    # Add arguments: output compression and precision
+    addCompressionArguments(parser)
+    addPrecisionArguments(parser)
 
     # Parse the arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    setPrecision(args.precision)
     print(args)
 
     # Specify variables
     inFn = args.input
     baseDir = os.path.dirname(inFn)
-    transformDir = os.path.join(baseDir, "generated_transforms")
-    if not os.path.exists(transformDir):
-        os.mkdir(transformDir)
     #outFn = os.path.join(baseDir, "moving_brain.nii.gz")
     outFn = args.output
-    logFn = os.path.join(baseDir, "motion_variables.csv")
 
-    # Set up log file header
-    header = "Volume Number, X Angle, Y Angle, Z Angle, X Translation, Y Translation, Z Translation\n"
-    updateFile(logFn, header)
-    
     print("Loading the image")
     # Load image
     seq, coords = mil.loadBOLD(inFn)
 
-    # Make list for storing volumes of new image
-    newSeq = []
+    # Generate or replay the motion for every volume in the sequence
+    rng = np.random.default_rng(args.seed)
+    trajectory = getMotionTrajectory(seq.shape[-1], args.trajectory, rng, args.rotation_std, args.translation_std)
 
-    # Assume no motion in the initial image
-    xAngle = 0.0
-    yAngle = 0.0
-    zAngle = 0.0
-    xShift = 0.0
-    yShift = 0.0
-    zShift = 0.0
+    if args.save_trajectory is not None:
+        saveTrajectory(args.save_trajectory, trajectory, args.seed)
 
-    # For every volume in the sequence
-    for i in range(seq.shape[-1]):
-
-        print("Volume:", i)
-
-        # Isolate image volume
-        vol = mil.isolateVolume(seq, i)
-
-        # Calculate the center of mass
-        offset = calculateCOM(vol)
-
-        dimensions = vol.shape
-        vol = sitk.GetImageFromArray(vol)
-
-        # Write the angles for the current transformation to the log file
-        line = str(i)+", "+str(xAngle)+", "+str(yAngle)+", "+str(zAngle)+", "+str(xShift)+", "+str(yShift)+", "+str(zShift)
-        updateFile(logFn, line)
+    # Apply the motion and record it
+    newSeq, centers = addMotionToSequence(seq, trajectory, args.com_interval, args.workers, args.pool)
+    saveMotionRecords(baseDir, trajectory, centers, args.export_transforms)
 
-            # Generate transformation
-        transform = generateAffineTransform(xAngle, yAngle, zAngle, (xShift, yShift, zShift), offset)
-       
-        # Apply transformation to image
-        volTransformed = performTransform(vol, transform)
-
-        # Save the transformation
-        fn = os.path.join(transformDir, str(i).zfill(3)+"_generated_Affine.mat")
-        saveTransformInfo(transform, fn)
-
-        # Convert the Image to an array so we can work with it
-        volNew = sitk.GetArrayFromImage(volTransformed)
-
-        # Add new image volume to sequence
-        newSeq.append(volNew)
-
-        # Update angles
-        zAngle = zAngle + delta()
-        yAngle = yAngle + delta()
-        xAngle = xAngle + delta()
-
-        # Check the new angles for the next image volume
-        xAngle, yAngle, zAngle = sanityCheckRotation(xAngle, yAngle, zAngle)
- 
-        # Update translations
-#        zShift = zShift + delta()
-#        yShift = yShift + delta()
-#        xShift = xShift + delta()
-
-        # Check the new translations for the next image volume
-        # UNDER DEVELOPMENT
-
-    # Convert the list of transformed image volumes into a BOLD sequence
-    newBOLD = mil.convertArrayToImage(newSeq, coords)
-    # Save the transformed BOLD sequence
-    mil.saveBOLD(newBOLD, outFn)
+    # Save the transformed BOLD sequence as the volumes are produced
+    with SequenceWriter(outFn, coords, seq.shape[:3], seq.shape[-1], seq.dtype,
+                        args.compress_level, args.compress_threads) as writer:
+        for volNew in newSeq:
+            writer.write(volNew)
 
 
 if __name__ == "__main__":
@@ -1,28 +1,43 @@
 import argparse
-from nipy import load_image, save_image
+import fcntl
+import glob
 import numpy as np
-import argparse
 import os
-from skimage import filters
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from boldli import ImageManipulatingLibrary as mil
 
-def calculateRates(roi, component):
+# Ways of scoring a component against an ROI
+SCORE_METHODS = ["raw", "pearson"]
+
+##
+# Count the true/false positives/negatives of a thresholded component
+#
+# Voxels where the ROI is 1 are positives and voxels where it is 0 are
+# negatives; any other ROI value is not counted.
+#
+# @param roi The ROI as a numpy array
+# @param component The thresholded component as a boolean numpy array
+#
+# @returns tp, fp, tn, fn The four counts
+def calculateConfusion(roi, component):
+    if roi.shape != component.shape:
+        raise ValueError("ROI has shape "+str(roi.shape)+", component has shape "+str(component.shape))
+
+    positives = roi == 1
+    negatives = roi == 0
+    component = component.astype(bool, copy=False)
 
-    tp = 0
-    fp = 0
-    tn = 0
-    fn = 0
-    
-    print(roi.shape == component.shape)
-    
-    for gt, c in zip(roi.flatten(), component.flatten()):
-        if gt==c==True:
-            tp+= 1
-        if gt==c==False:
-            tn+=1
-        if gt==True and c==False:
-            fn+=1
-        if gt==False and c==True:
-            fp+=1
+    tp = np.count_nonzero(positives & component)
+    fn = np.count_nonzero(positives) - tp
+    fp = np.count_nonzero(negatives & component)
+    tn = np.count_nonzero(negatives) - fp
+
+    return tp, fp, tn, fn
+
+def calculateRates(roi, component):
+    tp, fp, tn, fn = calculateConfusion(roi, component)
 
     tpr = tp/float(tp+fn)
     fnr = fn/float(tp+fn)
@@ -31,83 +46,204 @@ def calculateRates(roi, component):
 
     return tpr, fpr, tnr, fnr
 
-def main():
-    # set up argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--input_dir", type=str)
-    parser.add_argument("-r", "--roi-fn", type=str)
-    parser.add_argument("-t", "--regtype", type=str)
+##
+# Sweep the threshold of a component over all of its values
+#
+# The voxels are sorted by intensity once, and the true and false positive
+# counts at every threshold are cumulative sums over the sorted labels. Voxels
+# with equal intensities are counted at the same threshold.
+#
+# @param roi The ROI as a numpy array; 1 is a positive voxel, 0 a negative one
+# @param component The component intensities as a numpy array
+#
+# @returns thresholds Component is counted as positive where >= threshold, in decreasing order
+# @returns tpr True positive rate at each threshold, starting from (0, 0)
+# @returns fpr False positive rate at each threshold, starting from (0, 0)
+# @returns auc Area under the ROC curve
+def calculateRoc(roi, component):
+    if roi.shape != component.shape:
+        raise ValueError("ROI has shape "+str(roi.shape)+", component has shape "+str(component.shape))
 
-    # parse the args
-    args = parser.parse_args()
-    subjDir = args.input_dir
-    roiFn = args.roi_fn
-    regtype = args.regtype
-    
+    roi = np.ravel(roi)
+    scores = np.ravel(component)
+    labelled = (roi == 1) | (roi == 0)
+    scores = scores[labelled]
+    positive = roi[labelled] == 1
+
+    # Sort the intensities from high to low
+    order = np.argsort(scores, kind="mergesort")[::-1]
+    scores = scores[order]
+    positive = positive[order]
+
+    # Keep the last voxel of each run of equal intensities
+    last = np.nonzero(np.diff(scores))[0]
+    last = np.append(last, scores.size - 1)
+
+    tps = np.cumsum(positive)[last]
+    fps = (last + 1) - tps
+
+    tpr = np.concatenate([[0.0], tps / float(max(tps[-1], 1))])
+    fpr = np.concatenate([[0.0], fps / float(max(fps[-1], 1))])
+    thresholds = np.concatenate([[np.inf], scores[last]])
+
+    # Trapezoidal rule
+    auc = float(np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2.0))
+
+    return thresholds, tpr, fpr, auc
+
+##
+# Save an ROC curve to a .csv file
+#
+# @param fn The name of the .csv file
+# @param thresholds The thresholds from calculateRoc
+# @param tpr The true positive rates from calculateRoc
+# @param fpr The false positive rates from calculateRoc
+def saveRoc(fn, thresholds, tpr, fpr):
+    with open(fn, 'w') as f:
+        f.write("threshold, tpr, fpr\n")
+        for t, tp, fp in zip(thresholds, tpr, fpr):
+            f.write(str(t)+", "+str(tp)+", "+str(fp)+"\n")
+
+##
+# Score every component against one or more ROIs with one matrix product per chunk
+#
+# The components are viewed as a (voxels x components) matrix and the ROIs as a
+# (voxels x ROIs) matrix, so each chunk of components is scored against every
+# ROI by a single BLAS product. Only one chunk of components is in memory at a
+# time, so a memory-mapped component image is read a chunk at a time.
+#
+# "raw" is the dot product of the absolute values, the same as np.correlate of
+# the flattened images. "pearson" is the Pearson correlation coefficient of the
+# absolute values.
+#
+# @param components The components as a 4D numpy array (x, y, z, component)
+# @param rois A 3D numpy array, or a list of them
+# @param method "raw" or "pearson"
+# @param mask 3D numpy array; if given, only voxels where it is greater than 0 are scored
+# @param chunkSize Number of components to score at once
+#
+# @returns scores numpy array of shape (components, ROIs)
+def scoreComponents(components, rois, method="raw", mask=None, chunkSize=32):
+    if method not in SCORE_METHODS:
+        raise ValueError("Unknown scoring method '"+str(method)+"'")
+    if isinstance(rois, np.ndarray):
+        rois = [rois]
+
+    numComps = components.shape[-1]
+    voxels = np.prod(components.shape[:3])
+
+    # NIfTI data is usually in Fortran order; flatten in the components' own
+    # order so the (voxels x components) matrix is a view, not a copy
+    order = 'F' if np.isfortran(components) else 'C'
+    roiMatrix = np.stack([np.abs(np.ravel(roi, order=order)) for roi in rois], axis=-1)
+    compMatrix = np.reshape(components, (voxels, numComps), order=order)
+    if mask is not None:
+        inside = np.nonzero(np.ravel(mask, order=order) > 0)[0]
+        roiMatrix = roiMatrix[inside]
+    else:
+        inside = None
+
+    if method == "pearson":
+        n = float(roiMatrix.shape[0])
+        roiMean = roiMatrix.mean(axis=0)
+        roiStd = roiMatrix.std(axis=0)
+
+    scores = np.empty((numComps, roiMatrix.shape[1]))
+    for start in range(0, numComps, chunkSize):
+        stop = min(start + chunkSize, numComps)
+        block = np.abs(compMatrix[:, start:stop])
+        if inside is not None:
+            block = block[inside]
+        products = np.matmul(block.T, roiMatrix)
+
+        if method == "raw":
+            scores[start:stop] = products
+        else:
+            blockMean = block.mean(axis=0)
+            blockStd = block.std(axis=0)
+            covariance = products/n - np.outer(blockMean, roiMean)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scores[start:stop] = covariance / np.outer(blockStd, roiStd)
+
+    return scores
+
+##
+# Find the MELODIC component image in a MELODIC output directory
+#
+# An uncompressed melodic_IC.nii is preferred, since loadBOLD memory-maps it
+# and the components are then read a chunk at a time; otherwise the gzipped
+# image is read into memory.
+#
+# @param melodicDir The MELODIC output directory
+#
+# @returns fn The name of the component image
+def findComponentImage(melodicDir):
+    fn = os.path.join(melodicDir, "melodic_IC.nii")
+    if os.path.exists(fn):
+        return fn
+
+    return fn + ".gz"
+
+# Columns of the spectr-level summary file
+OVERVIEW_HEADER = "subject, registration, correlation, component, tpr, fpr, tnr, fnr\n"
+
+##
+# Analyze the MELODIC components of one subject and registration type
+#
+# Only the component image, the ROI and the optional mask are loaded. The
+# per-subject correlations (and ROC curve) are written to the subject's
+# directory; the summary row is returned for the caller to save.
+#
+# @param subjDir Directory of the subject, ending in a path separator
+# @param regtype The registration type, e.g. "rigid"
+# @param roiFn Filename of the ROI image
+# @param method "raw" or "pearson" (see scoreComponents)
+# @param maskFn Filename of a mask to score inside, or None
+# @param chunkSize Number of components to score at once
+# @param rocFn Name of the .csv file to save the ROC curve to, or None
+#
+# @returns result Dictionary of the summary values
+def analyzeSubject(subjDir, regtype, roiFn, method="raw", maskFn=None, chunkSize=32, rocFn=None):
     # Set up the file names
-    melodicFn = subjDir+regtype+"_melodic/melodic_IC.nii.gz"
-    correctedFn = subjDir+"corrected_"+regtype+".nii.gz"
-    stationaryFn = subjDir+"BOLD.nii.gz"
+    melodicFn = findComponentImage(subjDir+regtype+"_melodic")
     outFn = subjDir+regtype+"_components_correlations.csv"
-    overviewFn = "spectr_recovered_components.csv"
 
     # load the images
-    melodic = load_image(melodicFn)
-    melodicData = melodic.get_data()
-    melodicCoords = melodic.coordmap
-    roi = load_image(roiFn)
-    roiData = roi.get_data()
-    roiCoords = roi.coordmap
-    corrected = load_image(correctedFn)
-    corrData = corrected.get_data()
-    corrCoords = corrected.coordmap
-    stationary = load_image(stationaryFn)
-    statData = stationary.get_data()
-    statCoord = stationary.coordmap
-
-    print(roiData.shape)
+    melodicData, melodicCoords = mil.loadBOLD(melodicFn)
+    roiData, roiCoords = mil.loadBOLD(roiFn)
+
     if len(roiData.shape) == 4:
         roiData = np.average(roiData, axis=-1)
 
-    maxCorr = 0.0
-    maxCorrVol = 0
-    correlations = []
-    vols = []
-
     # Threshold the rois
-    melodicData = np.abs(melodicData)
     roiData = np.abs(roiData)
 
-    # for each volume in melodicData
-    for i in range(melodicData.shape[-1]):
-        # calculate the correlation with the roiData
-        corr = np.correlate(melodicData[:, :, :, i].flatten(), roiData.flatten())
-        correlations.append(corr[0])
-        vols.append(i)
-        # if the calculated correlation > max correlation
-        if corr > maxCorr:
-            # max correlation = calculated correlation
-            maxCorr = corr
-            # max corr volume = current volume number
-            maxCorrVol = i+1
+    mask = None
+    if maskFn is not None:
+        mask, _ = mil.loadBOLD(maskFn)
+
+    # Score every component against the roi
+    correlations = scoreComponents(melodicData, roiData, method, mask, chunkSize)[:, 0]
+    vols = list(range(len(correlations)))
+    bestComp = int(np.argmax(correlations))
+    maxCorr = correlations[bestComp]
+    # Components are reported numbered from 1
+    maxCorrVol = bestComp+1
 
     # sort the correlations and volume numbers
     sortCorrVols = sorted(zip(correlations, vols), reverse=True)
 
     # TPR/FPR
-    val = 0.1*np.amax(melodicData[:, :, :, maxCorrVol])
-    threshComp = melodicData[:, :, :, maxCorrVol] > (val)
+    bestData = np.abs(melodicData[:, :, :, bestComp])
+    val = 0.1*np.amax(bestData)
+    threshComp = bestData > (val)
 
     tpr, fpr, tnr, fnr = calculateRates(roiData, threshComp) 
 
-    # print results summary
-    print("MELODIC extracted", melodicData.shape[-1], "components.")
-    print("      Max correlation to DMN ROI:", maxCorr)
-    print("  Component with max correlation:", maxCorrVol)
-    print("                             TPR:", tpr)
-    print("                             FPR:", fpr)
-    print("                             TNR:", tnr)
-    print("                             FNR:", fnr)
+    # ROC over every threshold of the same component
+    thresholds, rocTpr, rocFpr, auc = calculateRoc(roiData, bestData)
+    if rocFn is not None:
+        saveRoc(rocFn, thresholds, rocTpr, rocFpr)
 
     # Save the results 
     with open(outFn, 'w') as f:
@@ -116,19 +252,128 @@ def main():
         for i in range(len(sortCorrVols)):
             f.write(str(sortCorrVols[i][0])+", "+str(sortCorrVols[i][1])+"\n")
 
+    return {"subject": subjDir, "registration": regtype, "components": melodicData.shape[-1],
+            "correlation": maxCorr, "component": maxCorrVol,
+            "tpr": tpr, "fpr": fpr, "tnr": tnr, "fnr": fnr, "auc": auc}
+
+##
+# Print the summary of one analysis
+#
+# @param result Dictionary returned by analyzeSubject
+def printSummary(result):
+    print("MELODIC extracted", result["components"], "components.")
+    print("      Max correlation to DMN ROI:", result["correlation"])
+    print("  Component with max correlation:", result["component"])
+    print("                             TPR:", result["tpr"])
+    print("                             FPR:", result["fpr"])
+    print("                             TNR:", result["tnr"])
+    print("                             FNR:", result["fnr"])
+    print("                             AUC:", result["auc"])
+
+##
+# Append summary rows to the spectr-level file
+#
+# The file is locked while the rows are written, so separate processes
+# appending at the same time never interleave or lose rows.
+#
+# @param fn The name of the summary .csv file
+# @param results List of dictionaries returned by analyzeSubject
+def appendOverview(fn, results):
+    with open(fn, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if f.tell() == 0:
+                f.write(OVERVIEW_HEADER)
+            for r in results:
+                f.write(r["subject"]+", "+r["registration"]+", "+str(r["correlation"])+", "+str(r["component"])+", "
+                        +str(r["tpr"])+", "+str(r["fpr"])+", "+str(r["tnr"])+", "+str(r["fnr"])+"\n")
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+##
+# Find every subject and registration type with MELODIC output
+#
+# Component images may be stored as melodic_IC.nii or melodic_IC.nii.gz;
+# analyzeSubject picks the uncompressed one when both exist.
+#
+# @param experimentDir Directory holding one subdirectory per subject
+# @param regtype Only find this registration type, or None for all of them
+#
+# @returns pairs Sorted list of (subject directory, registration type)
+def findAnalyses(experimentDir, regtype=None):
+    pattern = os.path.join(experimentDir, "*", ("*" if regtype is None else regtype)+"_melodic", "melodic_IC.nii*")
+
+    # A directory may hold both melodic_IC.nii and melodic_IC.nii.gz; list it once
+    pairs = set()
+    for fn in glob.glob(pattern):
+        if not fn.endswith((".nii", ".nii.gz")):
+            continue
+        melodicDir = os.path.dirname(fn)
+        subjDir = os.path.dirname(melodicDir) + os.sep
+        pairs.add((subjDir, os.path.basename(melodicDir)[:-len("_melodic")]))
+
+    return sorted(pairs)
+
+
+def main(argv=None):
+    # set up argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--input_dir", type=str)
+    parser.add_argument("-r", "--roi-fn", type=str)
+    parser.add_argument("-t", "--regtype", type=str)
+    parser.add_argument("-e", "--experiment-dir", type=str,
+                        help="Analyze every subject and registration type under this directory (with -t, only that type)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of analyses to run at once with -e")
+    parser.add_argument("--roc", type=str,
+                        help="Save the ROC curve of the best component to this .csv file (with -e, to REGTYPE_ROC in each subject directory)")
+    parser.add_argument("--method", type=str, default="raw", choices=SCORE_METHODS, help="How to score the components against the ROI")
+    parser.add_argument("--mask", type=str, help="Only score the voxels inside this mask")
+    parser.add_argument("--chunk-size", type=int, default=32, help="Number of components to score at once")
+
+    # parse the args
+    args = parser.parse_args(argv)
+    overviewFn = "spectr_recovered_components.csv"
+    options = {"method": args.method, "maskFn": args.mask, "chunkSize": args.chunk_size}
+
+    if args.experiment_dir is None:
+        result = analyzeSubject(args.input_dir, args.regtype, args.roi_fn, rocFn=args.roc, **options)
+        printSummary(result)
+        appendOverview(overviewFn, [result])
+        return
+
+    pairs = findAnalyses(args.experiment_dir, args.regtype)
+    print("Found", len(pairs), "analyses in", args.experiment_dir)
 
-    # Save best component info to spectr-level file
-    if not os.path.exists(overviewFn):
-        with open(overviewFn, 'w') as f:
-            f.write("subject, registration, correlation, component, tpr, fpr, tnr, fnr\n")
+    # Workers only write to their own subject directories; this process is the
+    # only one writing the summary file
+    failures = {}
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for subjDir, regtype in pairs:
+            rocFn = None if args.roc is None else subjDir+regtype+"_"+os.path.basename(args.roc)
+            future = executor.submit(analyzeSubject, subjDir, regtype, args.roi_fn, rocFn=rocFn, **options)
+            futures[future] = (subjDir, regtype)
 
-    with open(overviewFn, 'a') as f:
-        f.write(subjDir+", "+regtype+", "+str(maxCorr[0])+", "+str(maxCorrVol)+", "+str(tpr)+", "+str(fpr)+", "+str(tnr)+", "+str(fnr)+"\n")
+        for future in as_completed(futures):
+            subjDir, regtype = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                failures[(subjDir, regtype)] = traceback.format_exc()
+                print(subjDir, regtype, "FAILED")
+                print(failures[(subjDir, regtype)])
+                continue
 
+            print("------------------------")
+            print(subjDir, regtype)
+            printSummary(result)
+            appendOverview(overviewFn, [result])
 
-    # Print correlation between correctedData and BOLD data
-#    print("Correlation between corrected "+regtype+" and BOLD:", np.correlate(corrData.flatten(), statData.flatten()))
-#    print("Correlation between corrected "+regtype+" and roi: ", np.correlate(corrData.flatten(), roiData.flatten()))
+    print("------------------------")
+    print(len(pairs) - len(failures), "of", len(pairs), "analyses complete")
+    if failures:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
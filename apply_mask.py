@@ -1,15 +1,67 @@
 from boldli import ImageManipulatingLibrary as mil
+from boldli import SequenceWriter, addCompressionArguments
 import numpy as np
-from nipype.interfaces.fsl.maths import ApplyMask
+from nipy.core.api import Image
 import argparse
 
-def main():
+##
+# Apply a mask to a single volume
+#
+# Voxels where the mask is greater than 0 are kept and every other voxel is set
+# to 0, the same as fslmaths -mas. The volume keeps its data type.
+#
+# @param volume The image volume as a 3D numpy array
+# @param mask The mask as a 3D numpy array
+#
+# @returns maskedVol The masked volume
+def maskVolume(volume, mask):
+    return np.where(mask > 0, volume, 0).astype(volume.dtype, copy=False)
+
+##
+# Apply a mask to a volume or sequence, streaming 4D results to disk
+#
+# A 3D mask is applied to a 3D volume or to every volume of a 4D sequence, and
+# a 4D mask is applied volume by volume to a 4D sequence of the same length.
+# 4D results are written one volume at a time, so no masked copy of the full
+# sequence is held in memory.
+#
+# @param sequence The image volume or sequence as a numpy array
+# @param mask The mask as a numpy array
+# @param coords The coordinates for the image volume or sequence
+# @param outFn The location to save the masked image to
+# @param compressLevel The gzip level (0-9) for .gz outputs, or None for the default
+# @param threads Number of threads to compress with
+def applyMask(sequence, mask, coords, outFn, compressLevel=None, threads=1):
+    # If the mask has a dimension with a size of 1, squeeze it
+    if mask.ndim == 4 and mask.shape[-1] == 1:
+        mask = mask[:,:,:, 0]
+
+    if sequence.shape[:3] != mask.shape[:3]:
+        raise ValueError("Mask has shape "+str(mask.shape)+", sequence has shape "+str(sequence.shape))
+
+    if sequence.ndim == 3 and mask.ndim == 3:   # Case: 3D volume and 3D mask
+        mil.saveBOLD(Image(maskVolume(sequence, mask), coords), outFn, compressLevel, threads)
+    elif sequence.ndim == 4 and mask.ndim in (3, 4):    # Case: 4D sequence and 3D or 4D mask
+        if mask.ndim == 4 and mask.shape[-1] != sequence.shape[-1]:
+            raise ValueError("Mask has "+str(mask.shape[-1])+" volumes, sequence has "+str(sequence.shape[-1]))
+
+        with SequenceWriter(outFn, coords, sequence.shape[:3], sequence.shape[-1], sequence.dtype,
+                            compressLevel, threads) as writer:
+            for i in range(sequence.shape[-1]):
+                volumeMask = mask if mask.ndim == 3 else mil.isolateVolume(mask, i)
+                writer.write(maskVolume(mil.isolateVolume(sequence, i), volumeMask))
+    else:
+        raise ValueError("Cannot apply a "+str(mask.ndim)+"D mask to a "+str(sequence.ndim)+"D image")
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--scan', type=str, help='/path/to/scan/file')
     parser.add_argument('-m', '--mask', type=str, help='/path/to/mask/file')
     parser.add_argument('-o', '--output', type=str, help='/path/to/output/file')
+    addCompressionArguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Define variables
     sequenceFn = args.scan
@@ -23,54 +75,7 @@ def main():
     print("sequence", sequence.shape)
     print("mask", mask.shape)
 
-    masking = ApplyMask()
-    masking.inputs.in_file = sequenceFn
-    masking.inputs.mask_file = maskFn
-    masking.inputs.out_file = outFn
-    masking.run()
-
-#    # Load the sequence
-#    sequence, coords1 = mil.loadBOLD(sequenceFn)
-#
-#    # If the sequence has a dimension with a size of 1, squeeze it
-#    if sequence.shape[-1] == 1:
-#        sequence = np.squeeze(sequence)
-#    # If the mask has a dimension with a size of 1, squeeze it
-#    if mask.shape[-1] == 1:
-#        mask = np.squeeze(mask)
-#
-#    # Set up list of masked volumes
-#    maskedSeq = []
-#
-#    if len(sequence.shape) == 4 and len(mask.shape) == 3:  # Case: 4D sequence and 3D mask
-#        # For every volume in the spotted brain image
-#        for i in range(sequence.shape[-1]):
-#            # Isolate volume
-#            volume = mil.isolateVolume(sequence, i)
-#            # Apply the mask
-#            maskedVol = np.multiply(volume, mask)
-#            # Save the masked volume to the list of masked volumes
-#            maskedSeq.append(maskedVol)
-#    elif len(sequence.shape) == 4 and len(mask.shape) == 4: # Case: 4D sequence and 4D mask
-#        # make sure the 4th dimensions are the same length
-#        for i in range(sequence.shape[-1]):
-#            # Isolate the sequence and mask volumes
-#            sequenceVolume = mil.isolateVolume(sequence, i)
-#            maskVolume = mil.isolateVolume(mask, i)
-#            # Apply the mask
-#            maskedVol = np.multiply(sequenceVolume, maskVolume)
-#            # Save the masked volume to the list of masked volumes
-#            maskedSeq.append(maskedVol)
-#    elif len(sequence.shape) == 3 and len(mask.shape) == 3:
-#        # Apply the mask
-#        maskedVol = np.multiply(sequence, mask)
-#        # Save the masked volume to the list of masked volumes
-#        maskedSeq = maskedVol # instead of a list, save the single masked volume
-#
-#    
-#    # Save the masked sequence 
-#    seqImg = mil.convertArrayToImage(maskedSeq, coords1)
-#    mil.saveBOLD(seqImg, outFn) 
+    applyMask(sequence, mask, coords1, outFn, args.compress_level, args.compress_threads)
 
 if __name__ == "__main__":
     main()
@@ -1,30 +1,146 @@
 from __future__ import print_function
 import numpy as np
+import nibabel
+import gzip
+import zlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # For loading/saving the images
 from nipy.core.api import Image
 from nipy import load_image, save_image
-from nipype.interfaces import dcmstack
+from nipy.io.nifti_ref import nipy2nifti, nifti2nipy
+
+# gzip level used when none is given; matches nibabel's default for .nii.gz
+DEFAULT_COMPRESS_LEVEL = 1
+
+# Directories ending in this suffix hold a sequence in chunked storage
+CHUNK_SUFFIX = ".chunks"
+
+# Number of slices per chunk in chunked storage
+DEFAULT_SLAB_SIZE = 8
+
+# Floating point precisions the stages can compute and store in
+PRECISIONS = {
+    "float64": (np.float64, np.complex128),
+    "float32": (np.float32, np.complex64),
+}
+_precision = "float64"
+
+# Largest absolute difference expected between a float32 and a float64 run of
+# the same stages with the same seed, on the 0-1000 intensity scale
+FLOAT32_TOLERANCE = 0.05
+
+##
+# Set the floating point precision used by every stage in this process
+#
+# @param name "float64" (the default) or "float32"
+def setPrecision(name):
+    global _precision
+    if name not in PRECISIONS:
+        raise ValueError("Unknown precision '"+str(name)+"'")
+    _precision = name
+
+##
+# Get the real data type for the current precision
+#
+# @returns dtype np.float64 or np.float32
+def getFloatType():
+    return PRECISIONS[_precision][0]
+
+##
+# Get the complex data type for the current precision
+#
+# @returns dtype np.complex128 or np.complex64
+def getComplexType():
+    return PRECISIONS[_precision][1]
+
+##
+# Check a float32 result against the float64 result of the same run
+#
+# @param reference The float64 result as a numpy array
+# @param test The float32 result as a numpy array
+# @param tolerance Largest allowed absolute difference
+#
+# @returns ok True if every voxel is within tolerance
+# @returns maxDiff The largest absolute difference
+def checkPrecision(reference, test, tolerance=FLOAT32_TOLERANCE):
+    maxDiff = float(np.max(np.abs(np.asarray(reference, dtype=np.float64) - np.asarray(test, dtype=np.float64))))
+
+    return maxDiff <= tolerance, maxDiff
+
+##
+# Check whether a filename refers to a sequence in chunked storage
+#
+# @param fn The string specifying the path to the file or directory
+#
+# @returns chunked True if fn ends in CHUNK_SUFFIX
+def isChunked(fn):
+    return fn.rstrip("/").endswith(CHUNK_SUFFIX)
 
 class ImageManipulatingLibrary:
     ##
     # Load the image
     #
+    # Uncompressed .nii files are memory-mapped instead of read into memory,
+    # so indexing the returned array only reads the bytes that are used. The
+    # mapping is copy-on-write: modifying the array never changes the file.
+    # Chunked sequences (see ChunkedSequence) are read into memory in full.
+    #
+    # Floating point images wider than the current precision (see setPrecision)
+    # are converted to it.
+    #
     # @param fn The string specifying the path to the file
+    # @param mmap If False, always read the whole image into memory
     #
-    # @returns img The image sequence as an Image object
+    # @returns img The image sequence as a numpy array (np.memmap for .nii files)
     # @returns coords The coordinate system for the image sequence
-    def loadBOLD(fn):
-        imgObj = load_image(fn)
-        coords = imgObj.coordmap
-        img = imgObj.get_data()
+    def loadBOLD(fn, mmap=True):
+        if isChunked(fn):
+            store = ChunkedSequence(fn)
+            img, coords = store[:], store.coords
+        elif mmap and fn.endswith(".nii"):
+            imgObj = load_image(fn)
+            coords = imgObj.coordmap
+            # Scaled images cannot be mapped and are read into memory instead
+            img = np.asanyarray(nibabel.load(fn, mmap='c').dataobj)
+        else:
+            imgObj = load_image(fn)
+            coords = imgObj.coordmap
+            img = imgObj.get_data()
+
+        floatType = np.dtype(getFloatType())
+        if np.issubdtype(img.dtype, np.floating) and img.dtype.itemsize > floatType.itemsize:
+            img = img.astype(floatType)
 
         return img, coords
 
+    ##
+    # Open an image sequence for random access to volumes and regions
+    #
+    # Chunked sequences are opened without reading any chunks, and indexing
+    # them only decompresses the chunks that are needed. Any other file is
+    # loaded as by loadBOLD.
+    #
+    # @param fn The string specifying the path to the file
+    #
+    # @returns img A ChunkedSequence or a numpy array
+    # @returns coords The coordinate system for the image sequence
+    def openBOLD(fn):
+        if isChunked(fn):
+            store = ChunkedSequence(fn)
+            return store, store.coords
+
+        return ImageManipulatingLibrary.loadBOLD(fn)
+
     ##
     # Isolate a single volume from the sequence
     #
-    # @param seq The image sequence as an Image object
+    # For a memory-mapped sequence, only the bytes of the requested volume are read.
+    #
+    # @param seq The image sequence as an Image object or numpy array
     # @param volNum An int specifying the volume to isolate
     #
     # @returns vol The isolated volume
@@ -37,6 +153,21 @@ class ImageManipulatingLibrary:
 
         return vol
 
+    ##
+    # Make sure an image sequence can be modified in place
+    #
+    # Sequences such as the replicated baseline are read-only broadcast views;
+    # those are copied into a full array, anything else is returned as is.
+    #
+    # @param seq The image sequence as a numpy array
+    #
+    # @returns seq A writable version of the sequence
+    def ensureWritable(seq):
+        if not seq.flags.writeable:
+            seq = np.array(seq)
+
+        return seq
+
     ##
     # Convert a 4D numpy array to an Image object
     #
@@ -56,10 +187,467 @@ class ImageManipulatingLibrary:
     ## 
     # Save the standardized image sequence
     #
+    # Files ending in .nii are written uncompressed and files ending in .nii.gz
+    # are gzip compressed, at the default level unless compressLevel is given.
+    # Names ending in CHUNK_SUFFIX are written as a ChunkedSequence.
+    #
     # @param seq The standardized image sequence
     # @param fn The location to save the image sequence to
-    def saveBOLD(seq, fn):
-        save_image(seq, fn)
+    # @param compressLevel The gzip level (0-9) for .gz files, or None for the default
+    # @param threads Number of threads to compress with
+    def saveBOLD(seq, fn, compressLevel=None, threads=1):
+        if isChunked(fn):
+            data = seq.get_data()
+            if data.ndim != 4:
+                raise ValueError("Chunked storage holds 4D sequences, got shape "+str(data.shape))
+            with SequenceWriter(fn, seq.coordmap, data.shape[:3], data.shape[3], data.dtype,
+                                compressLevel, threads) as writer:
+                for i in range(data.shape[3]):
+                    writer.write(data[:,:,:, i])
+            return
+
+        if not fn.endswith(".gz") or (compressLevel is None and threads == 1):
+            save_image(seq, fn)
+            return
+
+        # Serialize the image in memory and compress it ourselves
+        niImg = nipy2nifti(seq)
+        with openCompressed(fn, compressLevel, threads) as f:
+            f.write(niImg.to_bytes())
+
+
+##
+# Add the compression options shared by every script to an argument parser
+#
+# @param parser The argparse.ArgumentParser to add the options to
+def addCompressionArguments(parser):
+    parser.add_argument('--compress-level', type=int, choices=range(10), metavar='{0-9}',
+                        help='gzip level for .nii.gz outputs (default '+str(DEFAULT_COMPRESS_LEVEL)+'); use a .nii name for no compression')
+    parser.add_argument('--compress-threads', type=int, default=1,
+                        help='Number of threads to compress .nii.gz outputs with')
+
+
+##
+# Add the precision option shared by every script to an argument parser
+#
+# @param parser The argparse.ArgumentParser to add the option to
+def addPrecisionArguments(parser):
+    parser.add_argument('--precision', type=str, default='float64', choices=sorted(PRECISIONS.keys()),
+                        help='Floating point precision to compute and save in')
+
+
+##
+# Open a file for writing, compressed if its name ends in .gz
+#
+# @param fn The location of the file
+# @param compressLevel The gzip level (0-9), or None for the default
+# @param threads Number of threads to compress with
+#
+# @returns f A writable binary file object
+def openCompressed(fn, compressLevel=None, threads=1):
+    if compressLevel is None:
+        compressLevel = DEFAULT_COMPRESS_LEVEL
+
+    if not fn.endswith(".gz"):
+        return open(fn, "wb")
+    elif threads > 1:
+        return ParallelGzipFile(fn, compressLevel, threads)
+    else:
+        return gzip.open(fn, "wb", compresslevel=compressLevel)
+
+
+class ParallelGzipFile:
+    ##
+    # Open a gzip file that compresses fixed-size blocks on a pool of threads
+    #
+    # Each block is written as its own gzip member. Concatenated members are
+    # standard gzip, so any gzip reader (including nibabel) reads the file as
+    # one stream. zlib releases the GIL, so the blocks compress in parallel.
+    #
+    # @param fn The location of the file
+    # @param compressLevel The gzip level (0-9)
+    # @param threads Number of threads to compress with
+    # @param blockSize Number of uncompressed bytes per block
+    def __init__(self, fn, compressLevel=DEFAULT_COMPRESS_LEVEL, threads=4, blockSize=2**22):
+        self.f = open(fn, "wb")
+        self.compressLevel = compressLevel
+        self.threads = threads
+        self.blockSize = blockSize
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.position = 0
+
+    ##
+    # Compress a block of data on the pool
+    #
+    # @param block The uncompressed bytes
+    def submit(self, block):
+        self.pending.append(self.executor.submit(gzip.compress, bytes(block), self.compressLevel, mtime=0))
+
+        # Write finished blocks in order, keeping a bounded number in flight
+        while len(self.pending) > 2*self.threads or (self.pending and self.pending[0].done()):
+            self.f.write(self.pending.popleft().result())
+
+    ##
+    # Write data to the file
+    #
+    # @param data The uncompressed bytes
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+
+        while len(self.buffer) >= self.blockSize:
+            self.submit(self.buffer[:self.blockSize])
+            del self.buffer[:self.blockSize]
+
+    ##
+    # Number of uncompressed bytes written so far
+    def tell(self):
+        return self.position
+
+    ##
+    # Compress the remaining data and close the file
+    def close(self):
+        if self.buffer:
+            self.submit(self.buffer)
+            self.buffer = bytearray()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        self.close()
+
+
+class SequenceWriter:
+    ##
+    # Open a NIfTI file to write an image sequence to one volume at a time
+    #
+    # The header is written immediately and each volume is appended to the
+    # file as it arrives, so the full sequence is never held in memory.
+    # Files ending in .gz are gzip compressed (see openCompressed), and names
+    # ending in CHUNK_SUFFIX are written as a ChunkedSequence instead.
+    #
+    # @param fn The location to save the image sequence to
+    # @param coords The 4D coordinates for the image sequence
+    # @param volShape The shape of a single volume
+    # @param numVols The number of volumes that will be written
+    # @param dtype The data type to store the volumes as, or None for the current precision
+    # @param compressLevel The gzip level (0-9) for .gz files, or None for the default
+    # @param threads Number of threads to compress with
+    def __init__(self, fn, coords, volShape, numVols, dtype=None, compressLevel=None, threads=1):
+        if dtype is None:
+            dtype = getFloatType()
+
+        self.fn = fn
+        self.volShape = tuple(volShape)
+        self.numVols = numVols
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+
+        if isChunked(fn):
+            self.f = None
+            self.store = ChunkedSequence.create(fn, coords, self.volShape + (numVols,), self.dtype,
+                                                compressLevel=compressLevel, threads=threads)
+            return
+        self.store = None
+
+        # Let nipy build the header for a single volume, then extend it in time
+        header = nipy2nifti(Image(np.zeros(self.volShape + (1,), self.dtype), coords)).header
+        header.set_data_shape(self.volShape + (numVols,))
+        header.set_data_dtype(self.dtype)
+        header.set_data_offset(352)
+
+        self.f = openCompressed(fn, compressLevel, threads)
+        header.write_to(self.f)
+        self.f.write(b"\x00" * (header.get_data_offset() - self.f.tell()))
+
+    ##
+    # Append the next volume to the file
+    #
+    # @param vol The image volume as a 3D numpy array
+    def write(self, vol):
+        if vol.shape != self.volShape:
+            raise ValueError("Volume has shape "+str(vol.shape)+", expected "+str(self.volShape))
+        if self.count >= self.numVols:
+            raise ValueError("All "+str(self.numVols)+" volumes of '"+self.fn+"' have already been written")
+
+        if self.store is not None:
+            self.store.writeVolume(self.count, vol)
+        else:
+            # NIfTI data is stored in Fortran order, so each volume is one contiguous block
+            self.f.write(np.asarray(vol, dtype=self.dtype).tobytes(order='F'))
+        self.count += 1
+
+    ##
+    # Close the file, checking that every volume was written
+    def close(self):
+        self.closeFile()
+        if self.count != self.numVols:
+            raise ValueError("Wrote "+str(self.count)+" of "+str(self.numVols)+" volumes to '"+self.fn+"'")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        # Do not mask the original error with an incomplete-file error
+        if excType is None:
+            self.close()
+        else:
+            self.closeFile()
+
+    ##
+    # Close the underlying file or chunk store
+    def closeFile(self):
+        if self.store is not None:
+            self.store.close()
+        else:
+            self.f.close()
+
+
+class ChunkedSequence:
+    ##
+    # Open an image sequence stored as a directory of compressed chunks
+    #
+    # Each volume is split along z into slabs of slabSize slices, and each
+    # (volume, slab) chunk is a separate zlib-compressed file. Reading a
+    # volume, or a region over time, only decompresses the chunks it covers,
+    # unlike a .nii.gz stream that has to be decompressed from the start.
+    #
+    # The directory holds:
+    #   header.nii  the NIfTI header of the sequence (coordinates, shape, type)
+    #   index.json  the shape, data type and slab size
+    #   VVVVV_SSS.z one chunk per volume VVVVV and slab SSS
+    #
+    # Index the object like a 4D numpy array with integers and slices, e.g.
+    # store[:,:,:, 120] for one volume or store[10:20, 30:40, 5:8, :] for a box
+    # over time.
+    #
+    # @param fn The directory of the sequence
+    # @param threads Number of threads to compress chunks with when writing
+    def __init__(self, fn, threads=1):
+        self.fn = fn
+        with open(os.path.join(fn, "index.json")) as f:
+            index = json.load(f)
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self.slabSize = index["slabSize"]
+        self.compressLevel = index["compressLevel"]
+        self.ndim = len(self.shape)
+        self.numSlabs = -(-self.shape[2] // self.slabSize)
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self._coords = None
+
+    ##
+    # Create an empty chunked sequence to write volumes to
+    #
+    # @param fn The directory to create; chunks already in it are removed
+    # @param coords The 4D coordinates for the image sequence
+    # @param shape The 4D shape of the sequence
+    # @param dtype The data type to store the volumes as
+    # @param slabSize Number of slices per chunk
+    # @param compressLevel The zlib level (0-9), or None for the default
+    # @param threads Number of threads to compress chunks with
+    #
+    # @returns store The ChunkedSequence, ready for writeVolume
+    @staticmethod
+    def create(fn, coords, shape, dtype, slabSize=DEFAULT_SLAB_SIZE, compressLevel=None, threads=1):
+        if compressLevel is None:
+            compressLevel = DEFAULT_COMPRESS_LEVEL
+
+        if not os.path.exists(fn):
+            os.makedirs(fn)
+        for name in os.listdir(fn):
+            if name.endswith(".z"):
+                os.remove(os.path.join(fn, name))
+
+        # Keep the NIfTI header so the coordinates survive the round trip
+        header = nipy2nifti(Image(np.zeros(tuple(shape[:3]) + (1,), dtype), coords)).header
+        header.set_data_shape(shape)
+        header.set_data_dtype(dtype)
+        with open(os.path.join(fn, "header.nii"), "wb") as f:
+            header.write_to(f)
+
+        index = {"shape": [int(n) for n in shape], "dtype": np.dtype(dtype).str,
+                 "slabSize": int(slabSize), "compressLevel": int(compressLevel)}
+        with open(os.path.join(fn, "index.json"), "w") as f:
+            json.dump(index, f)
+
+        return ChunkedSequence(fn, threads)
+
+    ##
+    # The coordinate system for the image sequence
+    @property
+    def coords(self):
+        if self._coords is None:
+            with open(os.path.join(self.fn, "header.nii"), "rb") as f:
+                header = nibabel.Nifti1Header.from_fileobj(f)
+            # nipy only needs the header; a broadcast array stands in for the data
+            data = np.broadcast_to(np.zeros(()), self.shape)
+            self._coords = nifti2nipy(nibabel.Nifti1Image(data, None, header)).coordmap
+
+        return self._coords
+
+    ##
+    # Get the filename of a chunk
+    #
+    # @param volNum The volume number
+    # @param slab The slab number
+    #
+    # @returns fn The path to the chunk
+    def chunkFile(self, volNum, slab):
+        return os.path.join(self.fn, str(volNum).zfill(5)+"_"+str(slab).zfill(3)+".z")
+
+    ##
+    # Get the range of slices in a slab
+    #
+    # @param slab The slab number
+    #
+    # @returns start, stop The first slice and one past the last slice
+    def slabBounds(self, slab):
+        start = slab * self.slabSize
+        return start, min(start + self.slabSize, self.shape[2])
+
+    ##
+    # Compress and write a single chunk
+    #
+    # @param volNum The volume number
+    # @param slab The slab number
+    # @param data The chunk as a 3D numpy array
+    def writeChunk(self, volNum, slab, data):
+        raw = np.ascontiguousarray(data, dtype=self.dtype).tobytes()
+        with open(self.chunkFile(volNum, slab), "wb") as f:
+            f.write(zlib.compress(raw, self.compressLevel))
+
+    ##
+    # Read and decompress a single chunk
+    #
+    # @param volNum The volume number
+    # @param slab The slab number
+    #
+    # @returns data The chunk as a 3D numpy array
+    def readChunk(self, volNum, slab):
+        start, stop = self.slabBounds(slab)
+        with open(self.chunkFile(volNum, slab), "rb") as f:
+            raw = zlib.decompress(f.read())
+
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.shape[:2] + (stop - start,))
+
+    ##
+    # Write a whole volume, one chunk per slab
+    #
+    # @param volNum The volume number
+    # @param vol The image volume as a 3D numpy array
+    def writeVolume(self, volNum, vol):
+        if vol.shape != self.shape[:3]:
+            raise ValueError("Volume has shape "+str(vol.shape)+", expected "+str(self.shape[:3]))
+
+        slabs = range(self.numSlabs)
+        def write(slab):
+            start, stop = self.slabBounds(slab)
+            self.writeChunk(volNum, slab, vol[:,:, start:stop])
+
+        # zlib releases the GIL, so the slabs compress in parallel
+        if self.executor is not None:
+            list(self.executor.map(write, slabs))
+        else:
+            for slab in slabs:
+                write(slab)
+
+    ##
+    # Read the slices of a volume, decompressing only the slabs that hold them
+    #
+    # @param volNum The volume number
+    # @param zs Array of slice numbers, or None for every slice
+    #
+    # @returns vol numpy array of shape (x, y, len(zs))
+    def readVolume(self, volNum, zs=None):
+        if zs is None:
+            zs = np.arange(self.shape[2])
+
+        vol = np.empty(self.shape[:2] + (len(zs),), dtype=self.dtype)
+        slabOfSlice = zs // self.slabSize
+        for slab in np.unique(slabOfSlice):
+            which = np.nonzero(slabOfSlice == slab)[0]
+            vol[:,:, which] = self.readChunk(volNum, slab)[:,:, zs[which] - slab*self.slabSize]
+
+        return vol
+
+    ##
+    # Read a region of interest over time
+    #
+    # Only the slabs that the mask touches are decompressed.
+    #
+    # @param mask 3D numpy array; voxels greater than 0 are in the region
+    # @param vols Array of volume numbers, or None for every volume
+    #
+    # @returns series numpy array of shape (voxels in the mask, volumes)
+    def readTimeSeries(self, mask, vols=None):
+        if vols is None:
+            vols = np.arange(self.shape[3])
+        mask = np.asarray(mask) > 0
+
+        zs = np.nonzero(np.any(mask, axis=(0, 1)))[0]
+        subMask = mask[:,:, zs]
+        series = np.empty((int(np.count_nonzero(subMask)), len(vols)), dtype=self.dtype)
+        for i, volNum in enumerate(vols):
+            series[:, i] = self.readVolume(volNum, zs)[subMask]
+
+        return series
+
+    ##
+    # Read part of the sequence with numpy-style indexing
+    #
+    # @param key Up to four integers or slices, for the x, y, z and time axes
+    #
+    # @returns data The selected part of the sequence as a numpy array
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 4 or any(not isinstance(k, (int, np.integer, slice)) for k in key):
+            raise IndexError("ChunkedSequence only supports up to four integers or slices")
+        key = key + (slice(None),) * (4 - len(key))
+        xKey, yKey, zKey, tKey = key
+
+        zs = np.atleast_1d(np.arange(self.shape[2])[zKey])
+        vols = np.atleast_1d(np.arange(self.shape[3])[tKey])
+
+        # x and y are indexed after reading, so the z axis is always last here
+        regionShape = np.empty(self.shape[:2] + (len(zs),), dtype=bool)[xKey, yKey].shape
+        data = np.empty(regionShape + (len(vols),), dtype=self.dtype)
+        for i, volNum in enumerate(vols):
+            data[..., i] = self.readVolume(volNum, zs)[xKey, yKey]
+
+        if not isinstance(zKey, slice):
+            data = data[..., 0, :]
+        if not isinstance(tKey, slice):
+            data = data[..., 0]
+
+        return data
+
+    ##
+    # Read the whole sequence when converted with np.asarray
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+
+        return data
+
+    def __len__(self):
+        return self.shape[0]
+
+    ##
+    # Stop the compression threads
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
 
 
 def main():
@@ -3,10 +3,10 @@ from skimage.measure import regionprops
 import argparse
 import os
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--input', type=str, help="Image that needs center of mass identified")
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Load the image
     img = load_image(args.input)
@@ -0,0 +1,30 @@
+from boldli import ImageManipulatingLibrary as mil
+from boldli import checkPrecision, FLOAT32_TOLERANCE
+import argparse
+import sys
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check a float32 output against the float64 output of the same run.")
+    parser.add_argument('-r', '--reference', type=str, help='Output of the float64 run')
+    parser.add_argument('-t', '--test', type=str, help='Output of the float32 run with the same seed')
+    parser.add_argument('--tolerance', type=float, default=FLOAT32_TOLERANCE, help='Largest allowed absolute difference')
+
+    args = parser.parse_args(argv)
+
+    reference, _ = mil.loadBOLD(args.reference, mmap=False)
+    test, _ = mil.loadBOLD(args.test, mmap=False)
+
+    if reference.shape != test.shape:
+        print("Shapes differ:", reference.shape, test.shape)
+        sys.exit(1)
+
+    ok, maxDiff = checkPrecision(reference, test, args.tolerance)
+    print("Largest absolute difference:", maxDiff, "(tolerance "+str(args.tolerance)+")")
+    if not ok:
+        print("FAILED")
+        sys.exit(1)
+    print("Within tolerance")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,85 +1,165 @@
 from boldli import ImageManipulatingLibrary as mil
+from boldli import addCompressionArguments
 import numpy as np
 import argparse
-from nipy import save_image, load_image
-from nipy.algorithms.resample import resample_img2img
-from nipype.interfaces.fsl import BinaryMaths
+import hashlib
+from nipy.core.api import Image
 import os
 
-def main():
+# Voxel-index mappings already computed, keyed by gridPairKey
+_voxelMappings = {}
+
+##
+# Get the key of a pair of voxel grids
+#
+# @param roiShape Shape of the ROI grid
+# @param roiAffine 4x4 voxel-to-world affine of the ROI grid
+# @param refShape Shape of the reference grid
+# @param refAffine 4x4 voxel-to-world affine of the reference grid
+#
+# @returns key Hexadecimal digest identifying the pair of grids
+def gridPairKey(roiShape, roiAffine, refShape, refAffine):
+    hasher = hashlib.sha1()
+    for shape, affine in [(roiShape, roiAffine), (refShape, refAffine)]:
+        hasher.update(np.asarray(shape, dtype=np.int64).tobytes())
+        hasher.update(np.asarray(affine, dtype=np.float64).tobytes())
+
+    return hasher.hexdigest()
+
+##
+# Map every voxel of the reference grid to its nearest voxel in the ROI grid
+#
+# @param roiShape Shape of the ROI grid
+# @param roiAffine 4x4 voxel-to-world affine of the ROI grid
+# @param refShape Shape of the reference grid
+# @param refAffine 4x4 voxel-to-world affine of the reference grid
+#
+# @returns mapping Flat ROI index for every reference voxel (C order), -1 outside the ROI grid
+def computeVoxelMapping(roiShape, roiAffine, refShape, refAffine):
+    # Reference voxel -> world -> ROI voxel
+    refToRoi = np.matmul(np.linalg.inv(roiAffine), refAffine)
+
+    refIjk = np.indices(refShape).reshape(3, -1)
+    roiIjk = np.matmul(refToRoi[:3, :3], refIjk) + refToRoi[:3, 3:]
+
+    # Like scipy.ndimage with order 0 (used by nipy's resampling): points
+    # outside the ROI's first and last voxel centers are 0, and halves round up
+    inside = np.all((roiIjk >= 0) & (roiIjk <= np.asarray(roiShape)[:, None] - 1), axis=0)
+    roiIjk = np.floor(roiIjk + 0.5).astype(np.intp)
+
+    mapping = np.full(refIjk.shape[1], -1, dtype=np.intp)
+    mapping[inside] = np.ravel_multi_index(roiIjk[:, inside], roiShape)
+
+    return mapping
+
+##
+# Get the voxel mapping for a pair of grids, computing it only once
+#
+# @param roiShape Shape of the ROI grid
+# @param roiAffine 4x4 voxel-to-world affine of the ROI grid
+# @param refShape Shape of the reference grid
+# @param refAffine 4x4 voxel-to-world affine of the reference grid
+#
+# @returns mapping Flat ROI index for every reference voxel, -1 outside the ROI grid
+def getVoxelMapping(roiShape, roiAffine, refShape, refAffine):
+    key = gridPairKey(roiShape, roiAffine, refShape, refAffine)
+    if key not in _voxelMappings:
+        _voxelMappings[key] = computeVoxelMapping(roiShape, roiAffine, refShape, refAffine)
+
+    return _voxelMappings[key]
+
+##
+# Load voxel mappings saved by a previous run
+#
+# @param fn Name of the .npz file holding the mappings
+def loadVoxelMappings(fn):
+    with np.load(fn) as data:
+        for key in data.files:
+            _voxelMappings[key] = data[key]
+
+##
+# Save every voxel mapping computed so far
+#
+# @param fn Name of the .npz file to save the mappings to
+def saveVoxelMappings(fn):
+    np.savez(fn, **_voxelMappings)
+
+##
+# Resample an ROI onto the reference grid by nearest neighbour
+#
+# @param roi The ROI as a 3D numpy array
+# @param roiAffine 4x4 voxel-to-world affine of the ROI
+# @param refShape Shape of the reference grid
+# @param refAffine 4x4 voxel-to-world affine of the reference grid
+#
+# @returns resampled The ROI on the reference grid, 0 outside the ROI's field of view
+def resampleRoi(roi, roiAffine, refShape, refAffine):
+    mapping = getVoxelMapping(roi.shape, roiAffine, refShape, refAffine)
+
+    inside = mapping >= 0
+    resampled = np.zeros(mapping.shape, dtype=np.float64)
+    resampled[inside] = np.ravel(roi)[mapping[inside]]
+
+    return resampled.reshape(refShape)
+
+##
+# Combine any number of ROIs on the grid of a reference image
+#
+# Each ROI is resampled onto the reference grid and the ROIs are joined with
+# a voxelwise maximum, so binary ROIs give their union.
+#
+# @param roiFns List of filenames of the ROI images
+# @param refFn Filename of the image with the reference coordinates
+#
+# @returns combined The combined ROIs as a 3D numpy array
+# @returns refCoords The coordinates of the reference image
+def combineRois(roiFns, refFn):
+    ref, refCoords = mil.loadBOLD(refFn)
+    refShape = ref.shape[:3]
+    print("coords", ref.shape)
+
+    combined = np.zeros(refShape)
+    for fn in roiFns:
+        roi, roiCoords = mil.loadBOLD(fn)
+        print(os.path.basename(fn), roi.shape)
+        if roi.ndim != 3:
+            raise ValueError("ROI '"+fn+"' has shape "+str(roi.shape)+", expected a 3D image")
+
+        np.maximum(combined, resampleRoi(roi, roiCoords.affine, refShape, refCoords.affine), out=combined)
+
+    return combined, refCoords
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-1', '--roi1', type=str, help='Filename of the first ROI image')
     parser.add_argument('-2', '--roi2', type=str, help='Filename of the second ROI image')
+    parser.add_argument('-i', '--rois', type=str, nargs='+', default=[], help='Filenames of any number of further ROI images')
     parser.add_argument('-c', '--coord-image', type=str, help='Filename of the coordinates image')
     parser.add_argument('-o', '--output-file', type=str, help='Filename to use for combined ROIs')
+    parser.add_argument('--mapping-cache', type=str, help='.npz file to reuse the voxel mappings from and save them to')
+    addCompressionArguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     print(args)
 
-    # check that both images exist
-    if not os.path.exists(args.roi1):
-        print("File '"+args.roi1+"' does not exist")
-    if not os.path.exists(args.roi2):
-        print("File '"+args.roi2+"' does not exist")
-    if not os.path.exists(args.coord_image):
-        print("File '"+args.coord_image)
-
-    # load both images for the purpose of checking coordinates
-    roi1, coords1 = mil.loadBOLD(args.roi1)
-    roi2, coords2 = mil.loadBOLD(args.roi2)
-    img, imgCoords = mil.loadBOLD(args.coord_image)
-
-    print("roi1", roi1.shape)
-    print("roi2", roi2.shape)
-    print("coords", img.shape)
-
-    # perform the OR-ing of the 2 rois
-    addingImgs = BinaryMaths()
-    addingImgs.inputs.in_file = args.roi1
-    addingImgs.inputs.operand_file = args.roi2
-    addingImgs.inputs.operation = "max"
-    addingImgs.inputs.out_file = args.output_file
-    addingImgs.run()
-
-    # resample the new roi to be in the coordinate frame of the coordinate image
-    jointRoi = load_image(args.output_file)
-    coordsImg = load_image(args.coord_image)
-    print("joint rois", jointRoi.get_data().shape)
-    newRoiImg = resample_img2img(jointRoi, coordsImg, order=0)
-    save_image(newRoiImg, args.output_file)
-
-    # create combo image
-#    combinedRoi = np.add(roi1, roi2)
-
-#    # Resize the combo image
-#    newImgArray = np.zeros(img.shape)
-#    i_coords, j_coords, k_coords = np.nonzero(combinedRoi)
-#
-#    # New affine transform
-#    affine_old_to_new = np.matmul(np.linalg.inv(imgCoords.affine), coords1.affine)
-#
-#    for i, j, k in zip(i_coords, j_coords, k_coords):
-#        # Find new coordinates
-#        vec_old = np.array([[i, j, k, 1]]).T
-#        vec_mid = np.matmul(affine_old_to_new, vec_old)
-#        vec_new = [int(m) for m in vec_mid]
-#
-#        # Include the surrounding positions
-#        #    1 -> 1 0 -> 1 1
-#        #         0 0    1 1
-#        for m in [vec_new[0], vec_new[0]+1]:
-#            for n in [vec_new[1], vec_new[1]+1]:
-#                for p in [vec_new[2], vec_new[2]+1]:
-#                    if m < img.shape[0] and n < img.shape[1] and p < img.shape[2]:
-#                        newImgArray[m][n][p] = 1
-#                    else:
-#                        print(vec_old.T, vec_new)
-#
-#    # save combo image
-#    combinedRoiImg = mil.convertArrayToImage(newImgArray, imgCoords)
-#    mil.saveBOLD(combinedRoiImg, args.output_file)
+    roiFns = [fn for fn in [args.roi1, args.roi2] if fn is not None] + args.rois
+
+    # check that every image exists
+    missing = [fn for fn in roiFns + [args.coord_image] if not os.path.exists(fn)]
+    if missing:
+        parser.error("File(s) do not exist: "+", ".join(missing))
+
+    if args.mapping_cache is not None and os.path.exists(args.mapping_cache):
+        loadVoxelMappings(args.mapping_cache)
+    numMappings = len(_voxelMappings)
+
+    combined, refCoords = combineRois(roiFns, args.coord_image)
+    mil.saveBOLD(Image(combined, refCoords), args.output_file, args.compress_level, args.compress_threads)
+
+    if args.mapping_cache is not None and len(_voxelMappings) > numMappings:
+        saveVoxelMappings(args.mapping_cache)
 
 
 if __name__ == '__main__':
     main()
-
@@ -1,15 +1,37 @@
 import SimpleITK as sitk
 import numpy as np
 import argparse
+import os
 
 ##
 # Generate a set of points to use to test the distance between the transforms
 # 
 # @param k The number of points to generate
+# @param seed Seed for the random number generator, or None for a random seed
+# @param low Lower bound of every coordinate
+# @param high Upper bound of every coordinate
 #
-# @return points A list of k points represented in 3D Cartesian space
-def generatePoints(k=10):
-    points = [tuple(np.random.uniform(size=3)) for i in range(k)]
+# @return points A numpy array of shape (k, 3) of points in 3D Cartesian space
+def generatePoints(k=10, seed=None, low=0.0, high=1.0):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(low, high, size=(k, 3))
+    return points
+
+##
+# Get the physical coordinates of the center of every voxel in a mask
+#
+# @param fn The location of the mask file as a string
+#
+# @return points A numpy array of shape (N, 3) of points in the physical space of the mask
+def generateMaskPoints(fn):
+    mask = sitk.ReadImage(fn)
+    # The array is indexed z, y, x; reverse the indices to x, y, z
+    indices = np.argwhere(sitk.GetArrayViewFromImage(mask) > 0)[:, ::-1].astype(np.float64)
+
+    direction = np.asarray(mask.GetDirection()).reshape(3, 3)
+    spacing = np.asarray(mask.GetSpacing())
+    origin = np.asarray(mask.GetOrigin())
+    points = origin + (indices * spacing) @ direction.T
     return points
 
 ##
@@ -22,56 +44,174 @@ def loadTransform(fn):
     xform = sitk.ReadTransform(fn)
     return xform
 
+##
+# Convert a transform to a 4x4 affine matrix
+#
+# The matrix is found by transforming the origin and the unit vectors, so any
+# affine transform (affine, Euler, versor, ...) can be converted.
+#
+# @param xform The sitk transform
+#
+# @return mat4 numpy array of shape (4, 4) of the affine matrix
+def transformToMatrix(xform):
+    origin = np.asarray(xform.TransformPoint((0.0, 0.0, 0.0)))
+
+    mat4 = np.eye(4)
+    for i in range(3):
+        mat4[:3, i] = np.asarray(xform.TransformPoint(tuple(np.eye(3)[i]))) - origin
+    mat4[:3, 3] = origin
+    return mat4
+
+##
+# Load transforms from files as 4x4 affine matrices
+#
+# @param fns List of the files containing the transforms
+#
+# @return mats numpy array of shape (T, 4, 4) of affine matrices
+def loadMatrices(fns):
+    mats = np.zeros((len(fns), 4, 4))
+    for i, fn in enumerate(fns):
+        mats[i] = transformToMatrix(loadTransform(fn))
+    return mats
+
+##
+# Calculate the distances between the points moved by two sets of transforms
+#
+# Since both transforms are affine, the distance for a point p is the norm of
+# (A1 - A2) p, so only the difference of the matrices is applied to the points.
+# The timepoints are processed a chunk at a time to bound the memory used.
+#
+# @param mats1 numpy array of shape (T, 4, 4) of affine matrices
+# @param mats2 numpy array of shape (T, 4, 4) of affine matrices
+# @param points numpy array of shape (N, 3) of points
+# @param chunkSize Number of timepoints to process at a time
+#
+# @return means numpy array of shape (T,) of the mean distance at every timepoint
+# @return maxes numpy array of shape (T,) of the largest distance at every timepoint
+# @return stds numpy array of shape (T,) of the standard deviation of the distances at every timepoint
+def calculateDisplacements(mats1, mats2, points, chunkSize=32):
+    diff = np.asarray(mats1) - np.asarray(mats2)
+    points = np.asarray(points, dtype=np.float64)
+
+    numVols = diff.shape[0]
+    means = np.zeros(numVols)
+    maxes = np.zeros(numVols)
+    stds = np.zeros(numVols)
+    for start in range(0, numVols, chunkSize):
+        stop = min(start + chunkSize, numVols)
+        # (chunk, N, 3) displacement of every point
+        displacements = points @ diff[start:stop, :3, :3].transpose(0, 2, 1) + diff[start:stop, np.newaxis, :3, 3]
+        norms = np.linalg.norm(displacements, axis=2)
+
+        means[start:stop] = norms.mean(axis=1)
+        maxes[start:stop] = norms.max(axis=1)
+        stds[start:stop] = norms.std(axis=1)
+
+    return means, maxes, stds
+
 ##
 # Compare pair of transforms using the norm of the difference between the transformed points
 #
 # @param f1 A string for a file containing sitk.AffineTransform object
 # @param f2 A string for a file containing sitk.AffineTransform object
-# @param points List of points (tuples) for comparing transforms
+# @param points Array or list of points for comparing transforms
 #
-# @return norms List of norms of the differences between two points
+# @return norms numpy array of the norms of the differences between the transformed points
 def compareTwoTransforms(f1, f2, points):
-    # Load the transforms
-    t1 = loadTransform(f1)
-    t2 = loadTransform(f2)
-
-    # Make a list for the calculated norms
-    norms = []
-    # For each point in the list of points,
-    for pt in points:
-        # Calculate the norm (default Frobenius) of the difference of the transformed points
-        norm = np.linalg.norm(t1.TransformPoint(pt) - t2.TransformPoint(pt))
-        # Add the norm to the list of norms
-        norms.append(norm)
-
-    # Returns the list of norms
-    return norms
+    # Load the transforms as matrices
+    diff = transformToMatrix(loadTransform(f1)) - transformToMatrix(loadTransform(f2))
+
+    # Calculate the norm of the difference of the transformed points
+    displacements = np.asarray(points, dtype=np.float64) @ diff[:3, :3].T + diff[:3, 3]
+    return np.linalg.norm(displacements, axis=1)
 
 ##
-# Compare generated and calculated motion for a single sequence
-def compareAllMotion():
-    # generate test points
-    points = generatePoints()
-    # save test points
+# Pair the transform files in two directories by timepoint
+#
+# The timepoint of a file is the number in the first 3 characters of its name.
+# Timepoints found in only one directory are skipped.
+#
+# @param dir1 The first directory of transforms
+# @param dir2 The second directory of transforms
+#
+# @return timepoints Sorted list of the timepoints found in both directories
+# @return fns1 List of the files in dir1 for each timepoint
+# @return fns2 List of the files in dir2 for each timepoint
+def matchTransformFiles(dir1, dir2):
+    def filesByTimepoint(directory):
+        files = {}
+        for f in sorted(os.listdir(directory)):
+            if os.path.isfile(os.path.join(directory, f)) and f[:3].isdigit():
+                files.setdefault(int(f[:3]), os.path.join(directory, f))
+        return files
+
+    files1 = filesByTimepoint(dir1)
+    files2 = filesByTimepoint(dir2)
+    timepoints = sorted(set(files1) & set(files2))
 
+    return timepoints, [files1[t] for t in timepoints], [files2[t] for t in timepoints]
+
+##
+# Compare generated and calculated motion for a single sequence
+#
+# @param generatedDir The directory of the generated transforms
+# @param calculatedDir The directory of the calculated transforms
+# @param points numpy array of shape (N, 3) of points for comparing transforms
+# @param chunkSize Number of timepoints to process at a time
+#
+# @return timepoints numpy array of the timepoints compared
+# @return means numpy array of the mean distance at every timepoint
+# @return maxes numpy array of the largest distance at every timepoint
+# @return stds numpy array of the standard deviation of the distances at every timepoint
+def compareAllMotion(generatedDir, calculatedDir, points, chunkSize=32):
     # for each timepoint in the calculated motion (generated motion has +1 length)
-    
+    timepoints, generatedFns, calculatedFns = matchTransformFiles(generatedDir, calculatedDir)
+
     # compare the two transforms
-    # store the difference between the transforms in a list of lists
-    # return the list of lists of norms
-    pass 
+    means, maxes, stds = calculateDisplacements(loadMatrices(generatedFns), loadMatrices(calculatedFns),
+                                                points, chunkSize)
+
+    return np.asarray(timepoints), means, maxes, stds
 
-def main():
-    # Testing
-    generatePoints()
+
+def main(argv=None):
     # Argparser set up
+    parser = argparse.ArgumentParser(description="Compare two directories of transforms by how far they move a set of points.")
     # Add arg for generated transform directory
+    parser.add_argument('-g', '--generated', type=str, help='Directory of the generated transforms')
     # Add arg for calculated transform directory
+    parser.add_argument('-c', '--calculated', type=str, help='Directory of the calculated transforms')
+    parser.add_argument('-m', '--mask', type=str, default=None,
+                        help='Use the centers of the voxels in this mask as the points')
+    parser.add_argument('-k', '--num-points', type=int, default=10000,
+                        help='Number of random points to use if no mask is given')
+    parser.add_argument('-r', '--radius', type=float, default=100.0,
+                        help='Random points are drawn from a cube of this half-width (mm) about the origin')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the random points')
+    parser.add_argument('--chunk-size', type=int, default=32, help='Number of timepoints to process at a time')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='CSV file to save the distances of every timepoint to')
     # Parse args
+    args = parser.parse_args(argv)
+
+    if args.mask is not None:
+        points = generateMaskPoints(args.mask)
+    else:
+        points = generatePoints(args.num_points, args.seed, -args.radius, args.radius)
+
     # Compare all motion in the generated and calculated directories
-    # Save the list of lists of norms to a file
-    # Calculate the mean and standard deviation of the norms
-    # Display the mean and standard deviation of the norms to the user
+    timepoints, means, maxes, stds = compareAllMotion(args.generated, args.calculated, points, args.chunk_size)
+
+    # Save the distances to a file
+    if args.output is not None:
+        np.savetxt(args.output, np.column_stack((timepoints, means, maxes, stds)), delimiter=",",
+                   header="timepoint,mean,max,std", comments="", fmt=["%d", "%.6f", "%.6f", "%.6f"])
+
+    # Display the mean and standard deviation of the distances to the user
+    print("Compared", len(timepoints), "timepoints using", len(points), "points")
+    print("Mean distance:", np.mean(means))
+    print("Std of mean distance:", np.std(means))
+    print("Largest distance:", np.max(maxes) if len(maxes) else 0.0)
 
 
 if __name__ == "__main__":
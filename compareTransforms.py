@@ -2,8 +2,32 @@ import argparse
 import numpy as np
 import scipy.io
 import pandas as pd
-import math
 import os
+from transform_store import composeAffineMatrices
+
+
+"""
+Calculate the percent error between every pair of motion matrices
+
+Each element's error is abs(e - o)/o, 0 where the elements are equal and
+2*sign(e) where only the original element is 0.
+
+@param matsOrig A np array of shape (T, 4, 4) of the original motion added to the image
+@param matsExp A np array of shape (T, 4, 4) of the estimated motion added to the image
+
+@return errors A np array of shape (T, 16) of the error of every element
+@return meanErrors A np array of shape (T,) of the mean error of every timepoint
+"""
+def calculatePercentErrors(matsOrig, matsExp):
+    origRot = np.asarray(matsOrig, dtype=np.float64).reshape(len(matsOrig), -1)
+    expRot = np.asarray(matsExp, dtype=np.float64).reshape(len(matsExp), -1)
+
+    # % error = abs(e - o)/o
+    with np.errstate(divide='ignore', invalid='ignore'):
+        errors = np.where(origRot != 0, np.abs(expRot - origRot)/origRot, 2*np.sign(expRot))
+    errors[origRot == expRot] = 0
+
+    return errors, errors.mean(axis=1)
 
 
 """
@@ -12,33 +36,26 @@ Calculate the percent error between the two motion matrices
 @param matOrig A np array representing the original motion added to the image
 @param matExp A np array representing the estimated motion added to the image
 
-@return
+@return line The error of every element followed by the mean error, comma separated
 """
 def calculatePercentError(matOrig, matExp):
-    origRot = matOrig.flatten()
-    expRot = matExp.flatten()
+    errors, meanErrors = calculatePercentErrors(matOrig[np.newaxis], matExp[np.newaxis])
+
+    return ",".join(str(error) for error in errors[0]) + "," + str(meanErrors[0]) + "\n"
 
-    line = ""
-    total = 0.0
 
-    for o, e in zip(origRot, expRot):
-        # % error = abs(e - o)/o
-        if o == e:
-            error = 0
-        elif o != 0:
-            error = abs(e - o)/float(o)
-        else: # o == 0
-            error = 2*e/(abs(float(e)))
-            print(e, o, error)
-        total += error
-        line += str(error) + ","
+"""
+Calculate the L2 norm difference between every pair of motion matrices
 
-    # get translation info
-#    line += str(matExp[0,-1])+","+str(matExp[1,-1])+","+str(matExp[2,-1])+","
+@param matsOrig A np array of shape (T, 4, 4) of the original motion added to the image
+@param matsExp A np array of shape (T, 4, 4) of the estimated motion added to the image
 
-    line += str(total/float(len(origRot))) + "\n"
+@return l2 A np array of shape (T,) of the L2 norm of every difference
+"""
+def calculateL2s(matsOrig, matsExp):
+    diff = np.asarray(matsOrig) - np.asarray(matsExp)
 
-    return line
+    return np.linalg.norm(diff.reshape(len(diff), -1), axis=1)
 
 
 """
@@ -47,57 +64,48 @@ Calculate the L2 norm difference between the two motion matrices
 @param matOrig A np array representing the original motion added to the image
 @param matExp A np array representing the estimated motion added to the image
 
-@return
+@return l2 The L2 norm of the difference
 """
 def calculateL2(matOrig, matExp):
-    origList = matOrig.flatten()
-    expList = matExp.flatten()
+    return calculateL2s(matOrig[np.newaxis], matExp[np.newaxis])[0]
 
-    # Find the difference between the matrices
-    diff = np.array([(o-e) for o, e in zip(origList, expList)])
 
-    # Calculate the L2 norm
-    l2 = np.linalg.norm(diff)
-    
-    return l2
+"""
+Load data from many .mat files and convert them to transform matrices
 
+The parameters of every file are read first and the offsets of all the
+matrices are then computed in one pass.
 
+@param fns The names of the files to load
 
+@return mats A np array of shape (T, 4, 4) of the transformation matrices
 """
-Load data from a .mat file and convert it to a transform matrix
+def loadCalculatedMatrices(fns):
+    params = np.zeros((len(fns), 12))
+    centers = np.zeros((len(fns), 3))
 
-@param fn The name of the file to load
+    for i, fn in enumerate(fns):
+        # Load the data from the .mat file
+        data = scipy.io.loadmat(fn)
+        keys = [key for key in data.keys() if not key.startswith("__")]
 
-@return mat4 The 4x4 transformation matrix
-"""
-def loadCalculatedMatrix(fn):
-    
-    # Load the data from the .mat file
-    data = scipy.io.loadmat(fn)
-    keys = list(data.keys())
-
-    # Interpret data stored in the .mat file
-    array = np.asarray(data[keys[0]])
-    mat3 = array[:9].reshape(3, 3)
-    translation = array[9:]
-    center = np.asarray(data[keys[1]])
+        # Interpret data stored in the .mat file
+        params[i] = np.asarray(data[keys[0]]).ravel()[:12]
+        centers[i] = np.asarray(data[keys[1]]).ravel()[:3]
 
     # Use translation and center to calculate offset
-    offset = []
-    for i in range(len(translation)):
-        offset.extend(translation[i] + center[i])
-        for j in range(len(translation)):
-            offset[i] -= mat3[i][j]*center[j]
+    return composeAffineMatrices(params[:, :9].reshape(-1, 3, 3), params[:, 9:], centers)
 
-    # Combine mat3 and offset to get mat4 (4x4 transformation matrix)
-    mat4 = []
-    for i in range(len(offset)):
-        mat4.append(np.append(mat3[i], offset[i]))
 
-    mat4.append(np.append(np.zeros(len(offset)), 1))
-    mat4 = np.asarray(mat4)
+"""
+Load data from a .mat file and convert it to a transform matrix
+
+@param fn The name of the file to load
 
-    return mat4
+@return mat4 The 4x4 transformation matrix
+"""
+def loadCalculatedMatrix(fn):
+    return loadCalculatedMatrices([fn])[0]
 
 """
 Load the .csv file of known motion added to the image sequence.
@@ -112,6 +120,48 @@ def loadAddedMotion(fn):
     # Return the data frame
     return df
 
+"""
+Convert many sets of motion parameters to transformation matrices
+
+@param xdeg Array of rotations about the x axis in degrees
+@param ydeg Array of rotations about the y axis in degrees
+@param zdeg Array of rotations about the z axis in degrees
+
+@returns mats A np array of shape (T, 4, 4) of rotation matrices
+"""
+def generateKnownMotionMatrices(xdeg, ydeg, zdeg):
+    # Convert angles to radians
+    xrad = np.radians(-np.asarray(xdeg, dtype=np.float64).ravel())
+    yrad = np.radians(-np.asarray(ydeg, dtype=np.float64).ravel())
+    zrad = np.radians(-np.asarray(zdeg, dtype=np.float64).ravel())
+
+    numVols = len(xrad)
+    matrixZ = np.tile(np.eye(4), (numVols, 1, 1))
+    matrixX = matrixZ.copy()
+    matrixY = matrixZ.copy()
+
+    # Rotation about the z axis
+    matrixZ[:, 1, 1] = np.cos(zrad)
+    matrixZ[:, 1, 2] = -np.sin(zrad)
+    matrixZ[:, 2, 1] = np.sin(zrad)
+    matrixZ[:, 2, 2] = np.cos(zrad)
+
+    # Rotation about the x axis
+    matrixX[:, 0, 0] = np.cos(xrad)
+    matrixX[:, 0, 2] = np.sin(xrad)
+    matrixX[:, 2, 0] = -np.sin(xrad)
+    matrixX[:, 2, 2] = np.cos(xrad)
+
+    # Rotation about the y axis
+    matrixY[:, 0, 0] = np.cos(yrad)
+    matrixY[:, 0, 1] = -np.sin(yrad)
+    matrixY[:, 1, 0] = np.sin(yrad)
+    matrixY[:, 1, 1] = np.cos(yrad)
+
+    # Composite matrices
+    return matrixZ @ matrixX @ matrixY
+
+
 """
 Convert motion parameters to a transformation matrix
 
@@ -122,83 +172,77 @@ Convert motion parameters to a transformation matrix
 @returns mat The 4x4 rotation matrix
 """
 def generateKnownMotionMatrix(xdeg, ydeg, zdeg):
-    # Convert angles to radians
-    xrad = math.radians(-xdeg) 
-    yrad = math.radians(-ydeg) 
-    zrad = math.radians(-zdeg)
+    return generateKnownMotionMatrices([xdeg], [ydeg], [zdeg])[0]
 
-    # Rotation about the z axis
-    matrixZ = np.array([[1, 0, 0, 0],
-                        [0, np.cos(zrad), -np.sin(zrad), 0],
-                        [0, np.sin(zrad), np.cos(zrad), 0],
-                        [0, 0, 0, 1]])    
 
-    # Rotation about the x axis
-    matrixX = np.array([[np.cos(xrad), 0, np.sin(xrad), 0],
-                        [0, 1, 0, 0],
-                        [-np.sin(xrad), 0, np.cos(xrad), 0],
-                        [0, 0, 0, 1]])
+"""
+Compare the transforms estimated for an image to the motion added to it
 
-    # Rotation about the y axis
-    matrixY = np.array([[np.cos(yrad), -np.sin(yrad), 0, 0],
-                        [np.sin(yrad), np.cos(yrad), 0, 0],
-                        [0, 0, 1, 0],
-                        [0, 0, 0, 1]])
+The transform files are matched to rows of the added motion by the first 3
+characters of their names and are compared in name order.
+
+@param transformPath The directory of the estimated .mat files
+@param motionFn The .csv file of the motion added to the image
+
+@returns l2 A np array of the L2 norm of the difference at every timepoint
+@returns meanErrors A np array of the mean percent error at every timepoint
+"""
+def compareImage(transformPath, motionFn):
+    # Load the dataframe of motion added to the image
+    xformDf = loadAddedMotion(motionFn)
 
-    # Composite matrix
-    mat = np.dot(np.dot(matrixZ, matrixX), matrixY)
-    
-    return mat
+    # Get the list of files in the transform directory
+    matFiles = sorted(f for f in os.listdir(transformPath) if os.path.isfile(os.path.join(transformPath, f)))
+
+    # Get the matrices from the .mat files
+    cMatrices = loadCalculatedMatrices([os.path.join(transformPath, f) for f in matFiles])
+    # Grab the first 3 characters of the filenames (not the base name!) and
+    # get the rows of the dataframe for them
+    rows = xformDf.iloc[[int(f[:3]) for f in matFiles], 1:4].to_numpy(dtype=np.float64)
+    # Get the transformation matrices for the rows
+    kMatrices = generateKnownMotionMatrices(rows[:, 0], rows[:, 1], rows[:, 2])
+
+    # Compare the matrices
+    l2 = calculateL2s(kMatrices, cMatrices)
+    _, meanErrors = calculatePercentErrors(kMatrices, cMatrices)
+
+    return l2, meanErrors
 
 
-def main():
+def main(argv=None):
     # Set up the argparser
     parser = argparse.ArgumentParser()
-    # Add argument for the image sequence name
-    parser.add_argument("-i", "--image", help="Image number", type=str)
+    # Add argument for the image sequence names
+    parser.add_argument("-i", "--image", help="Image numbers", type=str, nargs='+')
+    parser.add_argument("-d", "--data-dir", help="Directory of the image directories", type=str,
+                        default="/home/jenna/Research/data/sam/")
+    parser.add_argument("-m", "--metrics-dir", help="Directory to append the metrics to", type=str,
+                        default="/home/jenna/Research/data/sam/metrics/")
     # Parse the args
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-    basePath = "/home/jenna/Research/data/sam/"+args.image+"/"
-    transformPath = os.path.join(basePath, "transforms")
-#    metricsPath = os.path.join(basePath, "metrics")
-    metricsPath = "/home/jenna/Research/data/sam/metrics/"
+    metricsPath = args.metrics_dir
     if not os.path.exists(metricsPath):
         os.mkdir(metricsPath)
 
     # Set up the files for the calculated metrics
     l2Fn = os.path.join(metricsPath, "l2norms.csv")
-#    if not os.path.exists(l2Fn):
-#        with open(l2Fn, "w") as f:
-    line = args.image+","
+    errorFn = os.path.join(metricsPath, "percent_errors.csv")
 
+    l2Lines = ""
+    errorLines = ""
+    for image in args.image:
+        basePath = os.path.join(args.data_dir, image)
+        l2, meanErrors = compareImage(os.path.join(basePath, "transforms"),
+                                      os.path.join(basePath, "added_motion.csv"))
+
+        l2Lines += ",".join([image] + [str(value) for value in l2]) + "\n"
+        errorLines += ",".join([image] + [str(value) for value in meanErrors]) + "\n"
 
-    # Load the dataframe of motion added to the image
-    fn2 = os.path.join(basePath, "added_motion.csv")
-    xformDf = loadAddedMotion(fn2)
-    headers = list(xformDf)
-    
-    # Get the list of files in the transform directory
-    matFiles = [f for f in os.listdir(transformPath) if os.path.isfile(os.path.join(transformPath, f))]
-    # For each file
-    for f in matFiles:
-        # Get the matrix from the .mat file
-        cMatrix = loadCalculatedMatrix(os.path.join(transformPath, f))
-        # Grab the first 3 characters of the filename (not the base name!)
-        sub = int(f[:3])
-        # Get the row of the dataframe for that int
-        row = xformDf.iloc[sub]
-        # Get the transformation matrix for that row
-        kMatrix = generateKnownMotionMatrix(float(row[headers[1]]),
-                                            float(row[headers[2]]),
-                                            float(row[headers[3]]))
-        # Compare the two matrices
-#        print(calculatePercentError(kMatrix, cMatrix))
-        line += str(calculateL2(kMatrix, cMatrix))+","
-
-    line = line[:-1]+"\n"
     with open(l2Fn, "a") as f:
-        f.write(line)
+        f.write(l2Lines)
+    with open(errorFn, "a") as f:
+        f.write(errorLines)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,47 @@
+from boldli import ImageManipulatingLibrary as mil
+from boldli import SequenceWriter, ChunkedSequence, addCompressionArguments
+from boldli import isChunked, CHUNK_SUFFIX, DEFAULT_SLAB_SIZE
+import argparse
+
+##
+# Convert an image sequence between NIfTI and chunked storage
+#
+# The input is read and the output written one volume at a time where the
+# formats allow it, so a chunked input is never held in memory in full.
+#
+# @param inFn The sequence to convert (.nii, .nii.gz or a CHUNK_SUFFIX directory)
+# @param outFn The location to save the converted sequence to
+# @param slabSize Number of slices per chunk for a chunked output
+# @param compressLevel The compression level (0-9), or None for the default
+# @param threads Number of threads to compress with
+def convertSequence(inFn, outFn, slabSize=DEFAULT_SLAB_SIZE, compressLevel=None, threads=1):
+    seq, coords = mil.openBOLD(inFn)
+
+    if isChunked(outFn):
+        store = ChunkedSequence.create(outFn, coords, seq.shape, seq.dtype, slabSize, compressLevel, threads)
+        for i in range(seq.shape[-1]):
+            store.writeVolume(i, mil.isolateVolume(seq, i))
+        store.close()
+    else:
+        with SequenceWriter(outFn, coords, seq.shape[:3], seq.shape[-1], seq.dtype,
+                            compressLevel, threads) as writer:
+            for i in range(seq.shape[-1]):
+                writer.write(mil.isolateVolume(seq, i))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert an image sequence between NIfTI and chunked storage ("+CHUNK_SUFFIX+").")
+    parser.add_argument('-i', '--input', type=str, help='Filename of the image sequence to convert')
+    parser.add_argument('-o', '--output', type=str, help='Filename of the converted image sequence')
+    parser.add_argument('--slab-size', type=int, default=DEFAULT_SLAB_SIZE, help='Number of slices per chunk for a chunked output')
+    addCompressionArguments(parser)
+
+    args = parser.parse_args(argv)
+    print(args)
+
+    convertSequence(args.input, args.output, args.slab_size, args.compress_level, args.compress_threads)
+    print("Converted", args.input, "to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,16 @@
 from __future__ import print_function
 import argparse
 
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import nibabel
 import nibabel.processing
-from nilearn.image import math_img
 import numpy as np
-from boldli import ImageManipulatingLibrary as mil
-from nipy.core.api import CoordinateSystem, AffineTransform
 
 def changeCoords2(affine, scale, coords):
+    from nipy.core.api import AffineTransform
+
     domain = coords.function_domain
     outrange = coords.function_range
 
@@ -44,49 +46,84 @@ def changeCoords(affine, scale):
 
     return mod_affine
 
-def main():
-    # Future: add arguments for inFn, outFn, and volNum
-    parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input', type=str, help='/path/to/input/file')
-    parser.add_argument('-o', '--output', type=str, help='/path/to/input/file')
-
-    args = parser.parse_args()
-
-    # Specify filepaths
-    inFn = args.input
-    outFn = args.output
-
+# Target grids already computed, keyed by source grid and voxel size
+_targetGrids = {}
+_targetGridsLock = threading.Lock()
+
+##
+# Get the grid an image is resampled onto, computing it once per source grid
+#
+# Only the output shape and affine are shared; resample_from_to maps the voxels
+# and fits the spline for every image.
+#
+# @param shape Shape of the source image
+# @param affine 4x4 voxel-to-world affine of the source image
+# @param voxelSize List of the three output voxel sizes in mm
+#
+# @returns grid Tuple of the output shape and the output affine
+def getTargetGrid(shape, affine, voxelSize):
+    key = (tuple(shape), np.asarray(affine, dtype=np.float64).tobytes(), tuple(voxelSize))
+    with _targetGridsLock:
+        if key not in _targetGrids:
+            _targetGrids[key] = nibabel.processing.vox2out_vox((shape, affine), voxelSize)
+
+        return _targetGrids[key]
+
+##
+# Resample an image to a new voxel size and save it
+#
+# @param inFn The path to the input image
+# @param outFn The path to save the resampled image to
+# @param isMask If True, threshold the resampled image to a binary mask (>= 1)
+# @param voxelSize List of the three output voxel sizes in mm
+def downsampleImage(inFn, outFn, isMask=False, voxelSize=(4, 4, 4)):
     # load the image
     img = nibabel.load(inFn)
-    aff = img.affine
 
-    # resample the image
-    resampled = nibabel.processing.resample_to_output(img, [4,4,4])
-
-    scaling = np.abs(4 / aff[0][0])
+    # resample the image, the same as nibabel.processing.resample_to_output
+    grid = getTargetGrid(img.shape, img.affine, voxelSize)
+    resampled = nibabel.processing.resample_from_to(img, grid, order=3, mode="constant", cval=0.0)
 
     # If the image was a mask, threshold it to a binary image
-    if "mask" in inFn:
-        resampled = math_img("img >= 1", img=resampled)
-
-#     newAff = changeCoords(aff, scaling)
-#     print(aff)
-#     print(newAff)
-#     data = resampled.get_fdata()
-#     img = nibabel.Nifti1Image(data, newAff)
+    if isMask:
+        data = np.asanyarray(resampled.dataobj) >= 1
+        resampled = nibabel.Nifti1Image(data.astype(np.int8), resampled.affine)
 
     # Save the volume
-#    nibabel.save(img, outFn)
     nibabel.save(resampled, outFn)
 
-#     # Load the volume
-#     _, coords = mil.loadBOLD(inFn)
-#     
-#     # Resample coordinates
-#     newCoords = changeCoords(aff, scaling, coords)
-#     print(newCoords)
-#     newImg = mil.convertArrayToImage(data, newCoords)
-#     mil.saveBOLD(newImg, outFn)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resample images to a new voxel size. Give -i and -o once per image.")
+    parser.add_argument('-i', '--input', type=str, action='append', default=[], help='/path/to/input/file')
+    parser.add_argument('-o', '--output', type=str, action='append', default=[], help='/path/to/output/file')
+    parser.add_argument('-m', '--mask', type=str, action='append', default=[],
+                        help='Input that is a mask and is thresholded to a binary image after resampling')
+    parser.add_argument('-v', '--voxel-size', type=float, nargs='+', default=[4, 4, 4],
+                        help='Output voxel size in mm, one value or one per axis')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of images to resample at once')
+
+    args = parser.parse_args(argv)
+
+    # Specify filepaths
+    if len(args.input) != len(args.output):
+        parser.error("give one -o for every -i")
+    unknownMasks = [fn for fn in args.mask if fn not in args.input]
+    if unknownMasks:
+        parser.error("-m must name an input: "+", ".join(unknownMasks))
+
+    voxelSize = args.voxel_size
+    if len(voxelSize) == 1:
+        voxelSize = voxelSize * 3
+    elif len(voxelSize) != 3:
+        parser.error("give one voxel size or three")
+
+    # Resample the images, several at a time; scipy releases the GIL while interpolating
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(downsampleImage, inFn, outFn, inFn in args.mask, voxelSize)
+                   for inFn, outFn in zip(args.input, args.output)]
+        for inFn, outFn, future in zip(args.input, args.output, futures):
+            future.result()
+            print("Resampled", inFn, "to", outFn)
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,5 @@
 from boldli import ImageManipulatingLibrary as mil
+from boldli import addCompressionArguments, addPrecisionArguments, setPrecision
 import numpy as np
 import argparse
 from nipy.core.api import Image
@@ -6,13 +7,62 @@ import math
 import random
 import os
 
-def main():
+##
+# Add a synthetic BOLD signal to every ROI voxel of an image sequence
+#
+# BOLD signal: f(t) = s*(cos(2*pi*f0*(t-t_shift)) + a_shift)
+#
+# @param seq The image sequence as a 4D numpy array, modified in place
+# @param roi The ROI image as a 3D numpy array; nonzero voxels receive signal
+# @param f0 Fundamental frequency of the signal in Hz
+# @param rng The numpy.random.Generator used to draw the temporal shifts
+# @param returnSignal If True, also build the generated signal as its own image
+#
+# @returns seq The image sequence with the BOLD signal added
+# @returns signalData The generated signal alone as a 4D numpy array, in the
+#          sequence's precision, or None unless returnSignal is True
+def synthesizeBOLDSignal(seq, roi, f0=0.04, rng=None, returnSignal=False):
+    if rng is None:
+        rng = np.random.default_rng()
+
+    seq = mil.ensureWritable(seq)
+
+    # s: constant, 2.4% max value
+    s = .15*np.mean(seq)
+    # a_shift: amplitude shift
+    a_shift = .05*s
+
+    dim1, dim2, dim3 = np.nonzero(roi)
+
+    # t_shift: temporal shift, one per ROI voxel
+    t_shift = rng.uniform(low=0.0, high=(1.0/f0-f0), size=len(dim1))
+
+    # Build the (voxels x timepoints) signal in one broadcast
+    t = np.arange(seq.shape[-1])
+    signal = s * (np.cos(f0*math.pi*2*(t[np.newaxis, :] - t_shift[:, np.newaxis])) + a_shift)
+
+    # Scatter the time courses into the sequence, and the signal image if requested
+    signal = signal.astype(seq.dtype, copy=False)
+    seq[dim1, dim2, dim3, :] += signal
+    signalData = None
+    if returnSignal:
+        signalData = np.zeros(seq.shape, dtype=seq.dtype)
+        signalData[dim1, dim2, dim3, :] = signal
+
+    return seq, signalData
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--sequence', type=str, help='Filename of the sequence to add BOLD signal to')
     parser.add_argument('-r', '--roi', type=str, help='Filename of the ROI image of brain activity')
     parser.add_argument('-o', '--out-fn', type=str, help='Filename to use to save the image with BOLD signal')
+    parser.add_argument('--seed', type=int, help='Seed for the temporal shifts, for reproducible runs')
+    addCompressionArguments(parser)
+    addPrecisionArguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    setPrecision(args.precision)
     print(args)
 
     # NOTE: DOES BOLDLI LOAD BOLD RETURN THE IMAGE DATA AND THE COORDS OR JUST THE IMG AND THE COORDS? FIX TO RETURN DATA AND COORDS
@@ -21,44 +71,22 @@ def main():
     # Load ROI
     roi, roi_coords = mil.loadBOLD(args.roi)
 
-    # Create a new image of shape seq for saving the generated signal
-    signalData = np.zeros(seq.shape)
-
     print(seq.shape)
     print(roi.shape)
     print(seq_coords)
     print(roi_coords)
-    # BOLD signal: f(t) = s*cos(f0*t-delta)+e
-    # s: constant, 2.4% max value
     print(np.mean(seq[seq > 0]))
     print(0.3*np.mean(seq))
-    s = .15*np.mean(seq)
-    # f0: fundamental frequency, 0.04 Hz
-    f0 = 0.04
-
-    # Create a new image of shape seq for saving the generated signal
-    signalData = np.zeros(seq.shape)
-
-    dim1, dim2, dim3 = np.nonzero(roi)
-
-    for i, j, k in zip(dim1, dim2, dim3):
-        # t_shift: temporal shift
-        t_shift = np.random.uniform(low=0.0, high=(1.0/f0-f0))
-        # a_shift: amplitude shift, will be random
-        #a_shift = np.random.uniform(low=0.0, high=s/10)
-        a_shift = .05*s
 
-        for t in range(seq.shape[-1]):
-            signal = s * (np.cos(f0*math.pi*2*(t-t_shift)) + a_shift)
-            seq[i][j][k][t] += signal
-            signalData[i][j][k][t] = signal
+    rng = np.random.default_rng(args.seed)
+    seq, _ = synthesizeBOLDSignal(seq, roi, rng=rng)
 
     newImg = Image(seq, seq_coords)
-    mil.saveBOLD(newImg, args.out_fn)
+    mil.saveBOLD(newImg, args.out_fn, args.compress_level, args.compress_threads)
 
     newImg = Image(signalData, seq_coords)
     path = os.path.dirname(args.out_fn)
-    mil.saveBOLD(newImg, os.path.join(path, "generated_BOLD_signal.nii.gz"))
+    mil.saveBOLD(newImg, os.path.join(path, "generated_BOLD_signal.nii.gz"), args.compress_level, args.compress_threads)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,9 @@
 import numpy as np
 from nipy.core.api import Image
-from nipy import load_image, save_image
 import argparse
 from boldli import ImageManipulatingLibrary as mil
+from boldli import SequenceWriter, addCompressionArguments
+from boldli import addPrecisionArguments, setPrecision, getFloatType, getComplexType
 
 ##
 # Perform the fast Fourier transform on an image and return the magnitude and phase images
@@ -21,28 +22,42 @@ def volumeFFT(img):
 
 
 ##
-# Generate a single 3D Gaussian distribution at a 
-# specific location in the image
+# Create the random number generator used to draw the scanner noise
 #
-# @param img The image as a numpy array
-# @param intensity Float value to scale the intensity of the distribution
+# @param seed Integer seed for the generator. If None, a fresh seed is drawn from the OS
 #
-# @returns newImg The distribution located at (x, y, z) in a blank image
-def generateComplexGaussianNoise(imgshape, magIntensity=2.0, phaseIntensity=0.1):
-    
-    # Center of the image
-    x = imgshape[0]
-    y = imgshape[1]
-    z = imgshape[2]
-    
-    # Generate Gaussian noise
-    noise = [[[[magIntensity*np.random.standard_normal(), phaseIntensity*np.random.standard_normal()] for i in range(z)] for j in range(y)] for k in range(x)]
-    noise = np.asarray(noise)
-    print(noise[0, 0, 0])
-    print(noise.shape)
-    noise = 100*np.squeeze(noise.view(np.complex128))
-    print(noise[0, 0, 0])
-    
+# @returns rng The seeded numpy.random.Generator
+def createNoiseGenerator(seed=None):
+    rng = np.random.default_rng(seed)
+    return rng
+
+
+##
+# Generate complex Gaussian noise for a k-space volume or a batch of volumes
+#
+# The real (magnitude) and imaginary (phase) components are drawn together
+# in a single call, so drawing a batch of shape (n, x, y, z) gives the same
+# values as n consecutive calls with shape (x, y, z).
+#
+# @param imgshape Shape of the noise array, either (x, y, z) or (n, x, y, z)
+# @param magIntensity Float value to scale the real component of the noise
+# @param phaseIntensity Float value to scale the imaginary component of the noise
+# @param rng The numpy.random.Generator to draw from. If None, a new unseeded generator is used
+#
+# @returns noise The complex noise as a numpy array of shape imgshape, at the current precision
+def generateComplexGaussianNoise(imgshape, magIntensity=2.0, phaseIntensity=0.1, rng=None):
+    if rng is None:
+        rng = createNoiseGenerator()
+
+    # Draw the real and imaginary parts as interleaved pairs. They are always
+    # drawn in float64, so a float32 run uses the same noise as a float64 run
+    noise = rng.standard_normal(tuple(imgshape) + (2,)).astype(getFloatType(), copy=False)
+    noise[..., 0] *= 100*magIntensity
+    noise[..., 1] *= 100*phaseIntensity
+
+    # Reinterpret the pairs as complex values without copying
+    noise = noise.view(getComplexType())[..., 0]
+
     return noise
 
 
@@ -81,7 +96,135 @@ def volumeIFFTAndClean(kImg):
     return img
 
 
-def main():
+##
+# Look up the inverse real FFT to use for the batched noise path
+#
+# @param backend String naming the FFT library, either "numpy" or "scipy"
+# @param workers Number of threads to use for the transform (scipy only)
+#
+# @returns irfftn Function irfftn(x, s, axes) performing the inverse real FFT
+def getFFTBackend(backend="numpy", workers=1):
+    if backend == "numpy":
+        def irfftn(x, s, axes):
+            return np.fft.irfftn(x, s=s, axes=axes)
+    elif backend == "scipy":
+        import scipy.fft
+
+        def irfftn(x, s, axes):
+            return scipy.fft.irfftn(x, s=s, axes=axes, workers=workers)
+    else:
+        raise ValueError("Unknown FFT backend '"+str(backend)+"'")
+
+    return irfftn
+
+
+##
+# Fold the fftshift into a batch of centered k-space noise volumes
+#
+# The per-volume path adds centered noise to the shifted spectrum and keeps
+# the real part of the inverse FFT. By linearity, that equals the image plus
+# the real part of the inverse FFT of the unshifted noise, which in turn is
+# the inverse real FFT of the Hermitian part of the noise. This gathers the
+# half spectrum of that Hermitian part straight from the centered noise, so
+# neither the shift nor the full spectrum is ever materialized.
+#
+# @param noise Complex noise of shape (n, x, y, z) in centered (shifted) layout
+#
+# @returns half The Hermitian half spectrum of shape (x, y, z//2+1, n)
+def foldNoiseShift(noise):
+    x, y, z = noise.shape[1:]
+
+    # Positions of the frequencies +k and -k in the centered layout
+    posIdx = [(np.arange(m) + m//2) % m for m in (x, y)]
+    negIdx = [(m//2 - np.arange(m)) % m for m in (x, y)]
+    posIdx.append((np.arange(z//2 + 1) + z//2) % z)
+    negIdx.append((z//2 - np.arange(z//2 + 1)) % z)
+
+    # Put the volumes last to match the layout of the image data
+    noise = np.moveaxis(noise, 0, -1)
+    half = noise[np.ix_(*posIdx)]
+    half += np.conj(noise[np.ix_(*negIdx)])
+    half *= 0.5
+
+    return half
+
+
+##
+# Normalize, round and clip a batch of physical space volumes in place
+#
+# @param imgs The volumes as a numpy array of shape (x, y, z, n)
+#
+# @returns imgs The cleaned volumes
+def cleanVolumes(imgs):
+    imgs *= (1000.0/np.max(imgs, axis=(0, 1, 2), keepdims=True))
+    np.around(imgs, 8, out=imgs)
+    np.clip(imgs, 0.0, 1000.0, out=imgs)
+
+    return imgs
+
+
+##
+# Add k-space noise to every volume of a sequence, a chunk of volumes at a time
+#
+# Gives the same result as running volumeFFT, addImages and volumeIFFTAndClean
+# on each volume in turn with noise from the same generator, up to
+# floating point tolerance.
+#
+# @param data The image sequence as a 4D numpy array
+# @param scaling Float value to scale the real component of the noise
+# @param rng The numpy.random.Generator to draw the noise from
+# @param chunkSize Number of volumes to transform at once
+# @param backend String naming the FFT library, either "numpy" or "scipy"
+# @param workers Number of threads to use for the transform (scipy only)
+#
+# @returns An iterator of (start, stop, chunk), where chunk holds the noisy
+#          volumes start to stop-1 as a 4D numpy array
+def generateNoisyChunks(data, scaling=2.0, rng=None, chunkSize=10, backend="numpy", workers=1):
+    if rng is None:
+        rng = createNoiseGenerator()
+
+    irfftn = getFFTBackend(backend, workers)
+    spatialShape = data.shape[:3]
+    numVols = data.shape[-1]
+    signalNormFactor = np.max(data)
+
+    for start in range(0, numVols, chunkSize):
+        stop = min(start + chunkSize, numVols)
+
+        # Generate the noise for every volume in the chunk
+        noise = generateComplexGaussianNoise((stop - start,) + spatialShape, magIntensity=scaling, rng=rng)
+
+        # Transform the noise back to physical space and add it to the volumes
+        chunk = irfftn(foldNoiseShift(noise), s=spatialShape, axes=(0, 1, 2))
+        chunk = chunk.astype(getFloatType(), copy=False)
+        chunk += data[..., start:stop] * (1000.0/signalNormFactor)
+
+        print("Added noise to volumes", start, "to", stop - 1)
+
+        yield start, stop, cleanVolumes(chunk)
+
+
+##
+# Add k-space noise to every volume of a sequence held in memory
+#
+# @param data The image sequence as a 4D numpy array
+# @param scaling Float value to scale the real component of the noise
+# @param rng The numpy.random.Generator to draw the noise from
+# @param chunkSize Number of volumes to transform at once
+# @param backend String naming the FFT library, either "numpy" or "scipy"
+# @param workers Number of threads to use for the transform (scipy only)
+#
+# @returns noisyData The noisy image sequence as a 4D numpy array
+def addNoiseToSequence(data, scaling=2.0, rng=None, chunkSize=10, backend="numpy", workers=1):
+    noisyData = np.empty(data.shape, dtype=getFloatType())
+
+    for start, stop, chunk in generateNoisyChunks(data, scaling, rng, chunkSize, backend, workers):
+        noisyData[..., start:stop] = chunk
+
+    return noisyData
+
+
+def main(argv=None):
     # NEXT
     # [X] Check this script to make sure it runs correctly
     # [X] Add argparse
@@ -92,8 +235,16 @@ def main():
     parser.add_argument('-i', '--input', type=str, help='Image to add noise to')
     parser.add_argument('-o', '--output', type=str, help='Location to save noisy image')
     parser.add_argument('-s', '--scaling', type=float, help='Scaling factor for noise')
+    parser.add_argument('--seed', type=int, help='Seed for the noise generator, for reproducible runs')
+    parser.add_argument('-b', '--batch', action='store_true', help='Transform chunks of volumes at once (4D sequences only)')
+    parser.add_argument('--chunk-size', type=int, default=10, help='Number of volumes per chunk in batch mode')
+    parser.add_argument('--fft-backend', type=str, default='numpy', choices=['numpy', 'scipy'], help='FFT library to use in batch mode')
+    parser.add_argument('--workers', type=int, default=1, help='Number of FFT threads in batch mode (scipy backend only)')
+    addCompressionArguments(parser)
+    addPrecisionArguments(parser)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    setPrecision(args.precision)
 
     # maskedVolFn = "masked_base_volume.nii.gz"
     # outFn = "noisy_volume.nii.gz"
@@ -103,62 +254,68 @@ def main():
     else:
         scaling = args.scaling
 
-    img = load_image(args.input)
+    rng = createNoiseGenerator(args.seed)
+
+    data, coords = mil.loadBOLD(args.input)
 
     # Check image shape
-    if len(img.get_data().shape) == 3:
+    if len(data.shape) == 3:
         # Normalize signal range
-        imgData = img.get_data()
+        imgData = data
         imgData *= (1000.0/np.max(imgData))
 
         # Perform the FFT
         kspace = volumeFFT(imgData)
 
         # Generate complex Gaussian noise
-        noise = generateComplexGaussianNoise(kspace.shape, magIntensity=scaling)
+        noise = generateComplexGaussianNoise(kspace.shape, magIntensity=scaling, rng=rng)
 
         # Add complex Gaussian noise to the k-space image
         noisyKspace = addImages(kspace, noise)
 
         # Convert back to physical space
-        noisyImg = volumeIFFTAndClean(noisyKspace)
+        noisyImg = volumeIFFTAndClean(noisyKspace).astype(getFloatType(), copy=False)
 
         # Save noisy image
-        save_image(Image(noisyImg, img.coordmap), args.output)
-
-    elif len(img.get_data().shape) == 4:
-        print(img.get_data().shape)
+        mil.saveBOLD(Image(noisyImg, coords), args.output, args.compress_level, args.compress_threads)
 
-        noisyVols = []
-        signalNormFactor = np.max(img.get_data())
+    elif len(data.shape) == 4:
+        print(data.shape)
 
-        # Iterate through the volumes in the sequence
-        for i in range(img.get_data().shape[-1]):
-            # Isolate the volume
-            vol = mil.isolateVolume(img, i)
-            vol *= (1000.0/signalNormFactor)
+        # Write the noisy volumes to disk as they are produced
+        with SequenceWriter(args.output, coords, data.shape[:3], data.shape[-1],
+                            compressLevel=args.compress_level, threads=args.compress_threads) as writer:
+            if args.batch:
+                chunks = generateNoisyChunks(data, scaling=scaling, rng=rng, chunkSize=args.chunk_size,
+                                             backend=args.fft_backend, workers=args.workers)
+                for start, stop, chunk in chunks:
+                    for i in range(chunk.shape[-1]):
+                        writer.write(chunk[..., i])
+            else:
+                signalNormFactor = np.max(data)
 
-            # Perform the FFT
-            kspace = volumeFFT(vol)
+                # Iterate through the volumes in the sequence
+                for i in range(data.shape[-1]):
+                    # Isolate the volume
+                    vol = mil.isolateVolume(data, i)
+                    vol *= (1000.0/signalNormFactor)
 
-            # Generate complex Gaussian noise
-            noise = generateComplexGaussianNoise(kspace.shape, magIntensity=scaling)
+                    # Perform the FFT
+                    kspace = volumeFFT(vol)
 
-            # Add complex Gaussian noise to the k-space image
-            noisyKspace = addImages(kspace, noise)
+                    # Generate complex Gaussian noise
+                    noise = generateComplexGaussianNoise(kspace.shape, magIntensity=scaling, rng=rng)
 
-            # Convert back to physical space
-            newVol = volumeIFFTAndClean(noisyKspace)
-            print(vol[22, 22, 22])
-            print(newVol[22, 22, 22])
-            noisyVols.append(newVol)
+                    # Add complex Gaussian noise to the k-space image
+                    noisyKspace = addImages(kspace, noise)
 
-            print("Added noise to volume", i)
+                    # Convert back to physical space
+                    newVol = volumeIFFTAndClean(noisyKspace).astype(getFloatType(), copy=False)
+                    print(vol[22, 22, 22])
+                    print(newVol[22, 22, 22])
+                    writer.write(newVol)
 
-        noisySeq = mil.convertArrayToImage(noisyVols, img.coordmap)
-        print(noisySeq.get_data().shape)
-        # Save noisy image
-        mil.saveBOLD(noisySeq, args.output)
+                    print("Added noise to volume", i)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,150 @@
+from boldli import ImageManipulatingLibrary as mil
+from boldli import addCompressionArguments, addPrecisionArguments, setPrecision
+import numpy as np
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pipeline import INTERMEDIATES, runPipeline
+
+# Baseline sequence and ROI, loaded once per worker process
+_baseSeq = None
+_baseCoords = None
+_roi = None
+
+##
+# Load the inputs shared by every subject into the worker process
+#
+# @param seqFn Filename of the baseline image sequence
+# @param roiFn Filename of the ROI image of brain activity
+# @param precision Floating point precision to run the stages in
+def loadSharedInputs(seqFn, roiFn, precision="float64"):
+    global _baseSeq, _baseCoords, _roi
+    setPrecision(precision)
+    _baseSeq, _baseCoords = mil.loadBOLD(seqFn)
+    _roi, _ = mil.loadBOLD(roiFn)
+
+##
+# Parse a subject range such as "61-90" or a single subject such as "61"
+#
+# @param text The range as a string, with inclusive bounds
+#
+# @returns subjects List of subject numbers
+def parseSubjectRange(text):
+    if "-" in text:
+        first, last = text.split("-", 1)
+        return list(range(int(first), int(last) + 1))
+
+    return [int(text)]
+
+##
+# Generate the phantom for a single subject
+#
+# @param subject The subject number
+# @param outDir Directory of the subject's outputs
+# @param seed Sequence of integers seeding the subject's run
+# @param options Dictionary of keyword arguments for runPipeline
+#
+# @returns subject The subject number
+# @returns elapsed Time taken in seconds
+def generateSubject(subject, outDir, seed, options):
+    start = time.time()
+
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+
+    # Every subject starts from its own copy of the baseline sequence
+    seq = np.copy(_baseSeq)
+    runPipeline(seq, _baseCoords, _roi, os.path.join(outDir, "BOLD.nii.gz"), seed=seed, **options)
+
+    return subject, time.time() - start
+
+##
+# Generate the phantoms for many subjects on a pool of processes
+#
+# Subject i is seeded with (baseSeed, i), so any subject can be regenerated
+# on its own from the base seed.
+#
+# @param subjects List of subject numbers
+# @param seqFn Filename of the baseline image sequence
+# @param roiFn Filename of the ROI image of brain activity
+# @param dataDir Directory to create one subdirectory per subject in
+# @param baseSeed Integer seed for the whole dataset
+# @param workers Number of subjects to generate at once
+# @param options Dictionary of keyword arguments for runPipeline
+# @param precision Floating point precision to run the stages in
+#
+# @returns failures Dictionary mapping each failed subject to its traceback
+def generateDataset(subjects, seqFn, roiFn, dataDir, baseSeed, workers=1, options=None, precision="float64"):
+    if options is None:
+        options = {}
+
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=loadSharedInputs,
+                             initargs=(seqFn, roiFn, precision)) as executor:
+        futures = {}
+        for subject in subjects:
+            outDir = os.path.join(dataDir, str(subject))
+            future = executor.submit(generateSubject, subject, outDir, [baseSeed, subject], options)
+            futures[future] = subject
+
+        for future in as_completed(futures):
+            subject = futures[future]
+            try:
+                _, elapsed = future.result()
+                print("Subject", subject, "complete in", round(elapsed, 1), "s")
+            except Exception:
+                failures[subject] = traceback.format_exc()
+                print("Subject", subject, "FAILED")
+                print(failures[subject])
+
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate phantoms for a range of subjects in parallel.")
+    parser.add_argument('-s', '--sequence', type=str, help='Filename of the baseline image sequence')
+    parser.add_argument('-r', '--roi', type=str, help='Filename of the ROI image of brain activity')
+    parser.add_argument('-d', '--data-dir', type=str, help='Directory to create one subdirectory per subject in')
+    parser.add_argument('-i', '--subjects', type=str, help='Inclusive range of subject numbers, e.g. 61-90')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of subjects to generate at once')
+    parser.add_argument('-n', '--noise-scaling', type=float, default=2.0, help='Scaling factor for the scanner noise')
+    parser.add_argument('--seed', type=int, help='Seed for the whole dataset. If missing, one is drawn and printed')
+    parser.add_argument('-k', '--keep', type=str, nargs='*', default=[], choices=sorted(INTERMEDIATES.keys()),
+                        help='Intermediate images to save in every subject directory')
+    parser.add_argument('--export-transforms', action='store_true',
+                        help='Also write a .mat file per volume to every subject directory')
+    addCompressionArguments(parser)
+    addPrecisionArguments(parser)
+
+    args = parser.parse_args(argv)
+    print(args)
+
+    # Draw and report a dataset seed so the run can be repeated
+    baseSeed = args.seed
+    if baseSeed is None:
+        baseSeed = int(np.random.SeedSequence().entropy % (2**63))
+    print("Dataset seed:", baseSeed)
+
+    if not os.path.exists(args.data_dir):
+        os.makedirs(args.data_dir)
+
+    subjects = parseSubjectRange(args.subjects)
+    options = {"scaling": args.noise_scaling, "keep": args.keep, "exportTransforms": args.export_transforms,
+               "compressLevel": args.compress_level, "compressThreads": args.compress_threads}
+    failures = generateDataset(subjects, args.sequence, args.roi, args.data_dir, baseSeed,
+                               workers=args.workers, options=options, precision=args.precision)
+
+    # Report the outcome for every subject
+    print("------------------------")
+    print(len(subjects) - len(failures), "of", len(subjects), "subjects generated")
+    if failures:
+        print("Failed subjects:", ", ".join(str(s) for s in sorted(failures)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+from boldli import ImageManipulatingLibrary as mil
+from boldli import SequenceWriter, addCompressionArguments
+from boldli import addPrecisionArguments, setPrecision
+import numpy as np
+import argparse
+import os
+from nipy.core.api import Image
+
+from generate_BOLD_signal import synthesizeBOLDSignal
+from generate_background_noise import addNoiseToSequence
+from add_motion import getMotionTrajectory, addMotionToSequence, saveMotionRecords
+
+# Intermediate images that can be saved alongside the final output, without extension
+INTERMEDIATES = {
+    "signal": "generated_BOLD_signal",
+    "bold": "image_sequence_bold",
+    "noisy": "image_sequence_noisy",
+}
+
+##
+# Derive one independent random number generator per pipeline stage
+#
+# @param seed Integer or sequence of integers seeding the run, or None for a fresh seed
+#
+# @returns rngs Dictionary of numpy.random.Generator objects for the "bold", "noise" and "motion" stages
+def createStageGenerators(seed=None):
+    stages = ["bold", "noise", "motion"]
+    children = np.random.SeedSequence(seed).spawn(len(stages))
+    rngs = {stage: np.random.default_rng(child) for stage, child in zip(stages, children)}
+
+    return rngs
+
+##
+# Generate a phantom from a baseline sequence: BOLD signal, then scanner noise, then motion
+#
+# The stages pass the sequence to each other in memory. Only the final output,
+# the motion records and the intermediates named in keep are written to disk.
+#
+# @param seq The baseline image sequence as a 4D numpy array, modified in place
+# @param coords The coordinates for the image sequence
+# @param roi The ROI image as a 3D numpy array
+# @param outFn The location to save the final image sequence to
+# @param scaling Float value to scale the scanner noise
+# @param seed Integer or sequence of integers seeding the run, or None for a fresh seed
+# @param keep List of intermediates to save, from the keys of INTERMEDIATES
+# @param trajectoryFn Replay file to load the motion from, or None to generate it
+# @param rotationStd Standard deviation of the rotation steps in degrees
+# @param translationStd Standard deviation of the translation steps in voxels
+# @param comInterval Recompute the center of mass every comInterval volumes (0: once)
+# @param chunkSize Number of volumes per chunk in the noise stage
+# @param fftBackend FFT library for the noise stage, either "numpy" or "scipy"
+# @param workers Number of threads for the noise and motion stages
+# @param exportTransforms If True, also write a .mat file per volume
+# @param compressLevel The gzip level (0-9) for .gz outputs, or None for the default
+# @param compressThreads Number of threads to compress .gz outputs with
+# @param compressIntermediates If False, save the intermediates as uncompressed .nii files
+def runPipeline(seq, coords, roi, outFn, scaling=2.0, seed=None, keep=(), trajectoryFn=None,
+                rotationStd=1.0, translationStd=0.0, comInterval=1, chunkSize=10,
+                fftBackend="numpy", workers=1, exportTransforms=False, compressLevel=None,
+                compressThreads=1, compressIntermediates=True):
+    outDir = os.path.dirname(outFn)
+    rngs = createStageGenerators(seed)
+
+    # Save an intermediate image under its standard name
+    ext = ".nii.gz" if compressIntermediates else ".nii"
+    def saveIntermediate(data, name):
+        fn = os.path.join(outDir, INTERMEDIATES[name] + ext)
+        mil.saveBOLD(Image(data, coords), fn, compressLevel, compressThreads)
+
+    # Stage 1: BOLD signal
+    print("Generating the BOLD signal")
+    seq, signalData = synthesizeBOLDSignal(seq, roi, rng=rngs["bold"], returnSignal="signal" in keep)
+    if signalData is not None:
+        saveIntermediate(signalData, "signal")
+        del signalData
+    if "bold" in keep:
+        saveIntermediate(seq, "bold")
+
+    # Stage 2: scanner noise
+    print("Adding scanner noise")
+    seq = addNoiseToSequence(seq, scaling=scaling, rng=rngs["noise"], chunkSize=chunkSize,
+                             backend=fftBackend, workers=workers)
+    if "noisy" in keep:
+        saveIntermediate(seq, "noisy")
+
+    # Stage 3: motion
+    print("Adding motion to the brain")
+    trajectory = getMotionTrajectory(seq.shape[-1], trajectoryFn, rngs["motion"], rotationStd, translationStd)
+    newSeq, centers = addMotionToSequence(seq, trajectory, comInterval, workers)
+    saveMotionRecords(outDir, trajectory, centers, exportTransforms)
+
+    # Save the final sequence as the volumes are produced
+    with SequenceWriter(outFn, coords, seq.shape[:3], seq.shape[-1], seq.dtype,
+                        compressLevel, compressThreads) as writer:
+        for volNew in newSeq:
+            writer.write(volNew)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a phantom from a baseline sequence in one process.")
+    parser.add_argument('-s', '--sequence', type=str, help='Filename of the baseline image sequence')
+    parser.add_argument('-r', '--roi', type=str, help='Filename of the ROI image of brain activity')
+    parser.add_argument('-o', '--output', type=str, help='Filename to use to save the final image sequence')
+    parser.add_argument('-n', '--noise-scaling', type=float, default=2.0, help='Scaling factor for the scanner noise')
+    parser.add_argument('--seed', type=int, help='Seed for the run, for reproducible phantoms')
+    parser.add_argument('-k', '--keep', type=str, nargs='*', default=[], choices=sorted(INTERMEDIATES.keys()),
+                        help='Intermediate images to save next to the output')
+    parser.add_argument('-t', '--trajectory', type=str, help='Replay file (.npz) to load the motion trajectory from')
+    parser.add_argument('--rotation-std', type=float, default=1.0, help='Standard deviation of the rotation steps in degrees')
+    parser.add_argument('--translation-std', type=float, default=0.0, help='Standard deviation of the translation steps in voxels')
+    parser.add_argument('--com-interval', type=int, default=1, help='Recompute the center of mass every N volumes (0: once per sequence)')
+    parser.add_argument('--chunk-size', type=int, default=10, help='Number of volumes per chunk in the noise stage')
+    parser.add_argument('--fft-backend', type=str, default='numpy', choices=['numpy', 'scipy'], help='FFT library for the noise stage')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of threads for the noise and motion stages')
+    parser.add_argument('--export-transforms', action='store_true', help='Also write a .mat file per volume')
+    parser.add_argument('--uncompressed-intermediates', action='store_true', help='Save the intermediates as .nii instead of .nii.gz')
+    addCompressionArguments(parser)
+    addPrecisionArguments(parser)
+
+    args = parser.parse_args(argv)
+    print(args)
+    setPrecision(args.precision)
+
+    # Load the baseline sequence and the ROI
+    seq, coords = mil.loadBOLD(args.sequence)
+    roi, _ = mil.loadBOLD(args.roi)
+
+    runPipeline(seq, coords, roi, args.output, scaling=args.noise_scaling, seed=args.seed,
+                keep=args.keep, trajectoryFn=args.trajectory, rotationStd=args.rotation_std,
+                translationStd=args.translation_std, comInterval=args.com_interval,
+                chunkSize=args.chunk_size, fftBackend=args.fft_backend, workers=args.workers,
+                exportTransforms=args.export_transforms, compressLevel=args.compress_level,
+                compressThreads=args.compress_threads,
+                compressIntermediates=not args.uncompressed_intermediates)
+    print("Done")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,53 +18,50 @@
 # * sandbox/dDMN_orig.nii.gz
 # * sandbox/vDMN_orig.nii.gz 
 
+# Steps 1-4 are deterministic, so stage_cache.py reuses their outputs when the
+# inputs, the command and the code are unchanged. Run with
+# STAGE_CACHE_ARGS=--no-cache to always run them.
+CACHE="python stage_cache.py $STAGE_CACHE_ARGS"
+
 # Resample all of these images so that the new spatial resolution is 4mm x 4mm x 4mm
+# in one call, 4 images at a time. The mask (-m) is thresholded back to a binary image.
 
-python downsample_images.py -i sandbox/PD_orig.nii -o sandbox/PD.nii
-python downsample_images.py -i sandbox/mask_orig.nii -o sandbox/mask.nii
-python downsample_images.py -i sandbox/dDMN_orig.nii.gz -o sandbox/dDMN.nii.gz
-python downsample_images.py -i sandbox/vDMN_orig.nii.gz -o sandbox/vDMN.nii.gz
+$CACHE -i sandbox/PD_orig.nii sandbox/mask_orig.nii sandbox/dDMN_orig.nii.gz sandbox/vDMN_orig.nii.gz \
+       -o sandbox/PD.nii sandbox/mask.nii sandbox/dDMN.nii.gz sandbox/vDMN.nii.gz -- \
+    python downsample_images.py -w 4 \
+        -i sandbox/PD_orig.nii -o sandbox/PD.nii \
+        -i sandbox/mask_orig.nii -o sandbox/mask.nii -m sandbox/mask_orig.nii \
+        -i sandbox/dDMN_orig.nii.gz -o sandbox/dDMN.nii.gz \
+        -i sandbox/vDMN_orig.nii.gz -o sandbox/vDMN.nii.gz
 
 # Step 2: Combine the dorsal and ventral default mode network ROIs into the same file. You will also need to specify a file with the desired coordinate system, as the ROI files are saved in a different coordinate system than the structural images we are using and need to be resampled accordingly.
  
 echo "------------------------"
 echo "Combining ROIS"
-python combine_rois.py -1 sandbox/dDMN.nii.gz -2 sandbox/vDMN.nii.gz -c sandbox/PD.nii -o sandbox/dmn_roi.nii.gz
+$CACHE -i sandbox/dDMN.nii.gz sandbox/vDMN.nii.gz sandbox/PD.nii -o sandbox/dmn_roi.nii.gz -- python combine_rois.py -1 sandbox/dDMN.nii.gz -2 sandbox/vDMN.nii.gz -c sandbox/PD.nii -o sandbox/dmn_roi.nii.gz
 echo "Complete"
 
 # Step 3: Use the `apply_mask.py` script to apply the mask from the Average Brain data to the T1-weighted Average Brain to isolate the brain. Repeat for the ROI image.
 
 echo "------------------------"
 echo "Applying mask to input images"
-python apply_mask.py -s sandbox/PD.nii -m sandbox/mask.nii -o sandbox/masked_base_volume.nii.gz
-python apply_mask.py -s sandbox/dmn_roi.nii.gz -m sandbox/mask.nii -o sandbox/masked_dmn_roi.nii.gz
+$CACHE -i sandbox/PD.nii sandbox/mask.nii -o sandbox/masked_base_volume.nii.gz -- python apply_mask.py -s sandbox/PD.nii -m sandbox/mask.nii -o sandbox/masked_base_volume.nii.gz
+$CACHE -i sandbox/dmn_roi.nii.gz sandbox/mask.nii -o sandbox/masked_dmn_roi.nii.gz -- python apply_mask.py -s sandbox/dmn_roi.nii.gz -m sandbox/mask.nii -o sandbox/masked_dmn_roi.nii.gz
 echo "Complete"
  
 # Step 4: Use the `BaselineImageGenerator.py` script to replicate the `masked_base_volume.nii.gz` 149 times to create a sequence 150 volumes long.
  
 echo "------------------------"
 echo "Generating the baseline image sequence"
-python BaseImageGenerator.py -i sandbox/masked_base_volume.nii.gz -o sandbox/base_image_sequence.nii.gz
+$CACHE -i sandbox/masked_base_volume.nii.gz -o sandbox/base_image_sequence.nii.gz generated_brain_mask.nii.gz -- python BaseImageGenerator.py -i sandbox/masked_base_volume.nii.gz -o sandbox/base_image_sequence.nii.gz
 echo "Complete"
  
+# Steps 5-7 run in a single process so the sequence is passed between the stages in memory.
 # Step 5: Use the DMN ROIs to generate pseudo BOLD signal for the whole sequence. 
-
-echo "------------------------"
-echo "Generating the BOLD signal"
-python generate_BOLD_signal.py -s sandbox/base_image_sequence.nii.gz -r sandbox/masked_dmn_roi.nii.gz -o sandbox/image_sequence_bold.nii.gz
-echo "Complete"
-
 # Step 6: Add Guassian noise to every image volume in k-space to imitate scanner noise.
-
-echo "------------------------"
-echo "Adding scanner noise"
-python generate_background_noise.py -i sandbox/image_sequence_bold.nii.gz -o sandbox/image_sequence_noisy.nii.gz -s 100
-echo "Complete"
-
 # Step 7: Add motion to the brain. The motion rotates the head around the center of the brain. The rotations are saved in a .csv file.
 
 echo "------------------------"
-echo "Adding motion to the brain"
-python add_motion.py -i sandbox/image_sequence_noisy.nii.gz -o sandbox/pseudo_BOLD.nii.gz
+echo "Generating the BOLD signal, adding scanner noise and adding motion to the brain"
+python pipeline.py -s sandbox/base_image_sequence.nii.gz -r sandbox/masked_dmn_roi.nii.gz -o sandbox/pseudo_BOLD.nii.gz -n 100 -k signal bold noisy
 echo "Complete"
-
@@ -0,0 +1,118 @@
+import argparse
+import builtins
+import importlib
+import importlib.util
+import sys
+import time
+
+# Subcommands, mapped to the script that implements them and a short description.
+# Each script is only imported when its subcommand runs, so a subcommand only
+# pays for the libraries it uses.
+COMMANDS = {
+    "downsample": ("downsample_images", "Resample images to a new voxel size"),
+    "combine-rois": ("combine_rois", "Combine ROIs on the grid of a reference image"),
+    "apply-mask": ("apply_mask", "Apply a mask to a volume or sequence"),
+    "baseline": ("BaseImageGenerator", "Replicate a volume into a baseline sequence"),
+    "bold-signal": ("generate_BOLD_signal", "Add a pseudo BOLD signal to a sequence"),
+    "noise": ("generate_background_noise", "Add k-space scanner noise to a sequence"),
+    "motion": ("add_motion", "Add motion to a sequence"),
+    "pipeline": ("pipeline", "Run the BOLD signal, noise and motion stages in one process"),
+    "dataset": ("generate_dataset", "Generate phantoms for a range of subjects"),
+    "convert": ("convert_sequence", "Convert a sequence between NIfTI and chunked storage"),
+    "check-precision": ("check_precision", "Check a float32 output against a float64 output"),
+    "export-transforms": ("transform_store", "Export a transform store to .mat files"),
+    "cache": ("stage_cache", "Run a deterministic stage through the output cache"),
+    "center-of-mass": ("calculate_center_of_mass", "Print the center of mass of an image"),
+    "subtract": ("subtract_images", "Subtract one image from another"),
+    "analyze-melodic": ("analyze_melodic", "Compare MELODIC components to the ROI"),
+    "compare-transforms": ("compareTransforms", "Compare estimated transforms to the added motion"),
+    "compare-transformations": ("compareTransformations", "Compare two directories of transforms"),
+}
+
+
+class ImportProfiler:
+    ##
+    # Time every module imported while the profiler is installed
+    #
+    # builtins.__import__ is wrapped, so the time of a module includes the
+    # modules it imports in turn. Modules that were already imported are not
+    # timed again.
+    def __init__(self):
+        self.originalImport = builtins.__import__
+        self.times = {}
+        self.depth = 0
+
+    ##
+    # Import a module through the original __import__, timing first imports
+    def profiledImport(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # Name relative imports by the module they resolve to
+        fullName = name
+        if level > 0 and globals is not None and globals.get("__package__"):
+            fullName = importlib.util.resolve_name("." * level + name, globals["__package__"])
+
+        if fullName in sys.modules:
+            return self.originalImport(name, globals, locals, fromlist, level)
+
+        start = time.perf_counter()
+        self.depth += 1
+        try:
+            return self.originalImport(name, globals, locals, fromlist, level)
+        finally:
+            self.depth -= 1
+            elapsed = time.perf_counter() - start
+            if fullName not in self.times:
+                self.times[fullName] = (elapsed, self.depth)
+
+    def install(self):
+        builtins.__import__ = self.profiledImport
+
+    def uninstall(self):
+        builtins.__import__ = self.originalImport
+
+    ##
+    # Print the slowest imports
+    #
+    # @param limit Number of modules to list
+    # @param stream File to print to
+    def report(self, limit=25, stream=sys.stderr):
+        total = sum(elapsed for elapsed, depth in self.times.values() if depth == 0)
+        print("------------------------", file=stream)
+        print("Import time per module (including the modules it imports)", file=stream)
+        ranked = sorted(self.times.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (elapsed, depth) in ranked[:limit]:
+            print("{:10.1f} ms  {}".format(1000*elapsed, name), file=stream)
+        print("{:10.1f} ms  total".format(1000*total), file=stream)
+
+
+def main(argv=None):
+    commandList = "\n".join("  {:<24}{}".format(name, description) for name, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(prog="spectr", description="Simulated Phantom Emulating Cranial Transformations",
+                                     epilog="commands:\n" + commandList + "\n\nRun 'spectr COMMAND -h' for the options of a command.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--import-profile', action='store_true', help='Report the import time of every module')
+    parser.add_argument('command', choices=sorted(COMMANDS.keys()), metavar='COMMAND', help='The command to run')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='Options of the command')
+
+    args = parser.parse_args(argv)
+    moduleName = COMMANDS[args.command][0]
+
+    profiler = ImportProfiler() if args.import_profile else None
+    if profiler is not None:
+        profiler.install()
+
+    try:
+        if profiler is not None:
+            module = profiler.profiledImport(moduleName)
+        else:
+            module = importlib.import_module(moduleName)
+        # Usage messages of the command read "spectr COMMAND"
+        sys.argv = ["spectr " + args.command] + args.args
+        module.main(args.args)
+    finally:
+        if profiler is not None:
+            profiler.uninstall()
+            profiler.report()
+
+
+if __name__ == "__main__":
+    main()
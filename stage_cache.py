@@ -0,0 +1,279 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+# Directory the stage outputs are cached in unless --cache-dir is given
+DEFAULT_CACHE_DIR = os.environ.get("SPECTR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "spectr"))
+
+# Largest total size of the cache before the least recently used entries are evicted
+DEFAULT_MAX_SIZE = "10G"
+
+# Version of the key layout; changing it invalidates every cached entry
+KEY_VERSION = 1
+
+##
+# Parse a size such as "500M" or "10G" into a number of bytes
+#
+# @param text The size as a string, with an optional K, M, G or T suffix
+#
+# @returns size The size in bytes
+def parseSize(text):
+    units = {"K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+
+    return int(text)
+
+##
+# Hash the contents of a file, or of every file in a directory
+#
+# @param fn The path to the file or directory
+# @param hasher The hashlib object to update
+def hashPath(fn, hasher):
+    if os.path.isdir(fn):
+        for root, dirs, files in os.walk(fn):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                hasher.update(os.path.relpath(path, fn).encode())
+                hashPath(path, hasher)
+        return
+
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            hasher.update(block)
+
+##
+# Find a script and the modules of this repository it imports, recursively
+#
+# @param script The path to the Python script
+#
+# @returns fns Sorted list of the script and its local modules
+def findLocalModules(script):
+    scriptDir = os.path.dirname(os.path.abspath(script))
+    found = set()
+    todo = [os.path.abspath(script)]
+    while todo:
+        fn = todo.pop()
+        if fn in found:
+            continue
+        found.add(fn)
+
+        with open(fn) as f:
+            tree = ast.parse(f.read(), fn)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module is not None:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                moduleFn = os.path.join(scriptDir, name.split(".")[0] + ".py")
+                if os.path.exists(moduleFn):
+                    todo.append(moduleFn)
+
+    return sorted(found)
+
+##
+# Compute the cache key of a stage
+#
+# The key covers the command line, the contents of every input and the code
+# of every script in the command along with the local modules it imports, so
+# changing any of them runs the stage again.
+#
+# @param command List of the command and its arguments
+# @param inputs List of the input files of the stage
+#
+# @returns key Hexadecimal SHA-256 digest
+def computeKey(command, inputs):
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({"version": KEY_VERSION, "command": command}).encode())
+
+    for fn in inputs:
+        hasher.update(b"input\0")
+        hashPath(fn, hasher)
+
+    for arg in command:
+        if arg.endswith(".py") and os.path.isfile(arg):
+            for moduleFn in findLocalModules(arg):
+                hasher.update(b"code\0" + os.path.basename(moduleFn).encode())
+                hashPath(moduleFn, hasher)
+
+    return hasher.hexdigest()
+
+##
+# Copy a file or directory, replacing anything already at the destination
+#
+# @param src The path to copy from
+# @param dst The path to copy to
+def copyPath(src, dst):
+    if os.path.isdir(dst):
+        shutil.rmtree(dst)
+    parent = os.path.dirname(dst)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+
+    if os.path.isdir(src):
+        shutil.copytree(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+##
+# Get the total size of a file or directory
+#
+# @param fn The path to the file or directory
+#
+# @returns size The size in bytes
+def pathSize(fn):
+    if not os.path.isdir(fn):
+        return os.path.getsize(fn)
+
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(fn) for name in files)
+
+##
+# Restore the outputs of a cached stage
+#
+# @param entryDir The directory of the cache entry
+# @param outputs List of the output paths of the stage
+#
+# @returns hit True if the entry existed and was restored
+def restoreOutputs(entryDir, outputs):
+    if not os.path.exists(os.path.join(entryDir, "entry.json")):
+        return False
+
+    for i, fn in enumerate(outputs):
+        copyPath(os.path.join(entryDir, str(i)), fn)
+
+    # Mark the entry as recently used for eviction
+    os.utime(entryDir)
+
+    return True
+
+##
+# Store the outputs of a stage in the cache
+#
+# The entry is built under a temporary name and renamed into place, so an
+# interrupted run never leaves a partial entry behind.
+#
+# @param entryDir The directory of the cache entry
+# @param outputs List of the output paths of the stage
+# @param command List of the command and its arguments
+def storeOutputs(entryDir, outputs, command):
+    tmpDir = entryDir + ".tmp" + str(os.getpid())
+    os.makedirs(tmpDir)
+
+    for i, fn in enumerate(outputs):
+        copyPath(fn, os.path.join(tmpDir, str(i)))
+
+    entry = {"command": command, "outputs": outputs, "created": time.time()}
+    with open(os.path.join(tmpDir, "entry.json"), "w") as f:
+        json.dump(entry, f, indent=2)
+
+    if os.path.exists(entryDir):
+        shutil.rmtree(tmpDir)
+    else:
+        os.rename(tmpDir, entryDir)
+
+##
+# Remove the least recently used entries until the cache fits in maxSize
+#
+# @param cacheDir The cache directory
+# @param maxSize Largest total size in bytes
+#
+# @returns evicted Number of entries removed
+def evictEntries(cacheDir, maxSize):
+    entries = []
+    for name in os.listdir(cacheDir):
+        entryDir = os.path.join(cacheDir, name)
+        if os.path.exists(os.path.join(entryDir, "entry.json")):
+            entries.append((os.path.getmtime(entryDir), pathSize(entryDir), entryDir))
+
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, entryDir in sorted(entries):
+        if total <= maxSize:
+            break
+        shutil.rmtree(entryDir)
+        total -= size
+        evicted += 1
+
+    return evicted
+
+##
+# Run a stage, or restore its outputs from the cache if it has run before
+#
+# @param command List of the command and its arguments
+# @param inputs List of the input files of the stage
+# @param outputs List of the output files of the stage
+# @param cacheDir The cache directory
+# @param maxSize Largest total size of the cache in bytes
+# @param useCache If False, always run the stage and leave the cache untouched
+#
+# @returns returncode The exit status of the stage (0 for a cache hit)
+def runCachedStage(command, inputs, outputs, cacheDir=DEFAULT_CACHE_DIR, maxSize=parseSize(DEFAULT_MAX_SIZE), useCache=True):
+    if not useCache:
+        return subprocess.call(command)
+
+    key = computeKey(command, inputs)
+    entryDir = os.path.join(cacheDir, key)
+
+    if restoreOutputs(entryDir, outputs):
+        print("Cache hit", key[:12]+":", " ".join(command))
+        return 0
+
+    print("Cache miss", key[:12]+":", " ".join(command))
+    returncode = subprocess.call(command)
+    if returncode != 0:
+        return returncode
+
+    missing = [fn for fn in outputs if not os.path.exists(fn)]
+    if missing:
+        print("Not caching; outputs were not created:", ", ".join(missing))
+        return returncode
+
+    if not os.path.exists(cacheDir):
+        os.makedirs(cacheDir)
+    storeOutputs(entryDir, outputs, command)
+    evicted = evictEntries(cacheDir, maxSize)
+    if evicted:
+        print("Evicted", evicted, "cache entries")
+
+    return returncode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a deterministic stage, reusing its outputs if the inputs, "
+                                                 "command and code are unchanged.",
+                                     usage="%(prog)s [options] -i INPUT... -o OUTPUT... -- command [args...]")
+    parser.add_argument('-i', '--inputs', type=str, nargs='*', default=[], help='Input files of the stage')
+    parser.add_argument('-o', '--outputs', type=str, nargs='+', help='Output files of the stage')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR, help='Directory to cache the outputs in')
+    parser.add_argument('--max-size', type=str, default=DEFAULT_MAX_SIZE, help='Largest size of the cache, e.g. 500M or 10G')
+    parser.add_argument('--no-cache', action='store_true', help='Always run the stage and leave the cache untouched')
+
+    if argv is None:
+        argv = sys.argv[1:]
+    if "--" not in argv:
+        parser.error("give the stage command after --")
+    split = argv.index("--")
+    args = parser.parse_args(argv[:split])
+    command = argv[split+1:]
+    if not command:
+        parser.error("give the stage command after --")
+
+    returncode = runCachedStage(command, args.inputs, args.outputs, args.cache_dir,
+                                parseSize(args.max_size), not args.no_cache)
+    sys.exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
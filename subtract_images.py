@@ -1,13 +1,13 @@
 import argparse
 from nipype.interfaces.fsl import BinaryMaths
 
-def main():
+def main(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--original', type=str, help='Filename of the original image')
     parser.add_argument('-r', '--revised', type=str, help='Filename of the revised image')
     parser.add_argument('-d', '--difference', type=str, help='Filename of the difference image')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Calculate the difference between the two images
     differenceImg = BinaryMaths()
@@ -0,0 +1,95 @@
+import SimpleITK as sitk
+import numpy as np
+import argparse
+import os
+
+##
+# Convert rotation matrices, translations and centers to 4x4 affine matrices
+#
+# The affine maps a point p to M*(p - c) + c + t, the same convention as an
+# sitk.AffineTransform with matrix M, translation t and center c.
+#
+# @param rotations numpy array of shape (T, 3, 3) of rotation matrices
+# @param translations numpy array of shape (T, 3) of translations
+# @param centers numpy array of shape (T, 3) of rotation centers
+#
+# @returns matrices numpy array of shape (T, 4, 4) of affine matrices
+def composeAffineMatrices(rotations, translations, centers):
+    numVols = rotations.shape[0]
+
+    matrices = np.zeros((numVols, 4, 4))
+    matrices[:, :3, :3] = rotations
+    matrices[:, :3, 3] = translations + centers - np.einsum('tij,tj->ti', rotations, centers)
+    matrices[:, 3, 3] = 1.0
+
+    return matrices
+
+##
+# Save the transforms for a whole sequence to a single file
+#
+# @param fn Name of the .npz file to save the transforms to
+# @param matrices numpy array of shape (T, 4, 4) of affine matrices
+# @param centers numpy array of shape (T, 3) of rotation centers
+# @param parameters numpy array of shape (T, 6) of the motion parameters
+#        (x angle, y angle, z angle, x shift, y shift, z shift)
+def saveTransformStore(fn, matrices, centers, parameters):
+    np.savez(fn, matrices=np.asarray(matrices, dtype=np.float64),
+             centers=np.asarray(centers, dtype=np.float64),
+             parameters=np.asarray(parameters, dtype=np.float64))
+
+##
+# Load the transforms for a whole sequence from a single file
+#
+# @param fn Name of the .npz file to load the transforms from
+#
+# @returns matrices numpy array of shape (T, 4, 4) of affine matrices
+# @returns centers numpy array of shape (T, 3) of rotation centers
+# @returns parameters numpy array of shape (T, 6) of the motion parameters
+def loadTransformStore(fn):
+    with np.load(fn) as data:
+        matrices = data["matrices"]
+        centers = data["centers"]
+        parameters = data["parameters"]
+
+    return matrices, centers, parameters
+
+##
+# Write every transform in a store as a per-volume sitk .mat file
+#
+# @param fn Name of the .npz file holding the transforms
+# @param outDir Directory to write the .mat files to
+#
+# @returns fns List of the .mat files written
+def exportTransformStore(fn, outDir):
+    matrices, centers, parameters = loadTransformStore(fn)
+
+    if not os.path.exists(outDir):
+        os.mkdir(outDir)
+
+    fns = []
+    for i in range(matrices.shape[0]):
+        transform = sitk.AffineTransform(3)
+        transform.SetMatrix(matrices[i, :3, :3].ravel())
+        transform.SetTranslation(tuple(parameters[i, 3:]))
+        transform.SetCenter(tuple(centers[i]))
+
+        outFn = os.path.join(outDir, str(i).zfill(3)+"_generated_Affine.mat")
+        sitk.WriteTransform(transform, outFn)
+        fns.append(outFn)
+
+    return fns
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a transform store to per-volume .mat files.")
+    parser.add_argument("-i", "--input", type=str, help="Path to the transform store (.npz)")
+    parser.add_argument("-o", "--output-dir", type=str, help="Directory to write the .mat files to")
+
+    args = parser.parse_args(argv)
+
+    fns = exportTransformStore(args.input, args.output_dir)
+    print("Exported", len(fns), "transforms to", args.output_dir)
+
+
+if __name__ == "__main__":
+    main()